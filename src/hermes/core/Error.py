@@ -7,6 +7,7 @@ class Error:
             query_with_self: bool = False,
             not_registered: bool = False,
             already_registered: bool = False,
+            not_stored: bool = False,
             error_message: str = '',
         ):
         self.isolated: bool = isolated
@@ -15,7 +16,8 @@ class Error:
         self.already_registered: bool = already_registered
         self.nickname_already_in_use: bool = nickname_already_in_use
         self.user_doesnt_exist: bool = user_doesnt_exist
+        self.not_stored: bool = not_stored
         self.error_message: str = error_message
 
     def has_error(self) -> bool:
-        return self.user_doesnt_exist or self.nickname_already_in_use or self.already_registered or self.not_registered or self.query_with_self or self.isolated
\ No newline at end of file
+        return self.user_doesnt_exist or self.nickname_already_in_use or self.already_registered or self.not_registered or self.query_with_self or self.isolated or self.not_stored
\ No newline at end of file
@@ -69,14 +69,17 @@ class Hermes:
         # Create the message
         msg_key, msg_val = self._msg_tools.create_message(message, self._nickname, recipient, remote_pk)
         # Store msg
-        await self._dht.store(msg_key, json.dumps(asdict(msg_val)))
+        stored = await self._dht.store(msg_key, json.dumps(asdict(msg_val)))
         # Send the message over the TCP connection
         await self._tcp_server.send_message(msg_val, val.ip_address, val.tcp_port)
 
         # Update the msgbox
         msg_box = self._msg_tools.update_message_box(msg_val, msg_box, msg_key)
         # Store msgbox
-        await self._dht.store(msg_box_key, json.dumps(asdict(msg_box)))
+        stored = await self._dht.store(msg_box_key, json.dumps(asdict(msg_box))) and stored
+
+        if not stored:
+            return Error(not_stored=True, error_message="Message not stored on enough peers.")
 
         # Check valid recipient
         return Error()
@@ -1,23 +1,36 @@
 import logging
 import asyncio
+import bisect
+import heapq
+import time
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Iterable
 
 if TYPE_CHECKING:
     from hermes.kademlia.Contact import Contact
 
-from hermes.kademlia.Support import B_VAL
+from hermes.kademlia.Support import B_VAL, CONTACT_FRESHNESS
 from hermes.kademlia.Support import K_VAL
 from hermes.kademlia.KBucket import KBucket
 
 logger = logging.getLogger(__name__)
 
 class BucketList:
-    def __init__(self, id):
+    def __init__(self, id, our_contact: 'Contact' = None):
         self._buckets: list[KBucket] = []
         self._buckets.append(KBucket())
+        # Sorted lower bounds of the buckets, which partition the id space contiguously
+        self._lows: list[int] = [b.low for b in self._buckets]
         self.id = id
+        # Sender of the pings checking stale contacts, no pings are sent without it
+        self.our_contact = our_contact
         self.lock = asyncio.Lock()
+        # Least recently seen contacts of full buckets, waiting to be pinged
+        self._stale: dict[int, 'Contact'] = {}
+        self._pinging: set[int] = set()
+        self._ping_task: asyncio.Task | None = None
+        # Set once closed, no more pings are sent
+        self._closed = False
 
     async def add_contact(self, contact: 'Contact') -> None:
         """
@@ -28,39 +41,157 @@ class BucketList:
         contact.touch()
 
         # Ensure the following is executed atomically
-        while True:
-            async with self.lock:
-
+        async with self.lock:
+            while True:
                 #Get the appropriate k bucket where the contact should be inserted
-                kbucket = self.get_kbucket(contact.id)
+                index = self.get_kbucket_index(contact.id)
 
-                # if its already there, refresh it
-                if kbucket.contains(contact.id):
-                    logger.info(">>> Contact already in bucket, refreshing.")
-                    kbucket.replace_contact(contact)
+                if self._add_to_bucket(index, contact):
                     return
 
-                # if the bucket is full try to split it and try again
-                if kbucket.is_full():
-                    if self.can_split(kbucket):
-                        k1, k2 = kbucket.split()
-                        index = self.get_kbucket_index(contact.id)
+    async def add_contacts(self, contacts: Iterable['Contact']) -> None:
+        """
+        Add many contacts under a single acquisition of the lock.
+        Contacts are sorted by id, so those going into the same bucket form a contiguous group:
+        the bucket is resolved once per group, and when it has to split, the rest of the
+        group is regrouped over the two halves.
+        """
+        # Like successive add_contact calls, the last occurrence of an id wins
+        unique = {c.id: c for c in contacts}
+        pending = sorted(unique.values(), key=lambda c: c.id)
+        ids = [c.id for c in pending]
+
+        for contact in pending:
+            contact.touch()
+
+        async with self.lock:
+            start = 0
+            while start < len(pending):
+                index = self.get_kbucket_index(ids[start])
+                end = bisect.bisect_right(ids, self._buckets[index].high, lo=start)
+
+                for i in range(start, end):
+                    if not self._add_to_bucket(index, pending[i]):
+                        # The bucket was split, regroup the remaining contacts
+                        start = i
+                        break
+                else:
+                    start = end
+
+    def _add_to_bucket(self, index: int, contact: 'Contact') -> bool:
+        """
+        Add a contact to the bucket at the given index, which must be the contact's bucket.
+        The lock must be held by the caller.
+
+        Returns False if the bucket was full and got split instead, in which case the contact still has to be added.
+        """
+        kbucket = self._buckets[index]
+
+        # if its already there, refresh it
+        if kbucket.contains(contact.id):
+            logger.info(">>> Contact already in bucket, refreshing.")
+            kbucket.replace_contact(contact)
+            return True
+
+        if not kbucket.is_full():
+            kbucket.add_contact(contact)
+            return True
+
+        # if the bucket is full try to split it so the contact can be added again
+        if self.can_split(kbucket):
+            k1, k2 = kbucket.split()
+
+            # add new buckets to our bucket list
+            self._buckets[index] = k1
+            self._buckets.insert(index+1, k2)
+            self._lows.insert(index+1, k2.low)
+            self._buckets[index].touch()
+            self._buckets[index+1].touch()
+            return False
+
+        # Keep the contact as a replacement and check if the oldest one is still around,
+        # unless we heard from it recently
+        kbucket.add_replacement(contact)
+        head = kbucket.head()
+        if time.monotonic() - head.last_seen >= CONTACT_FRESHNESS:
+            self._schedule_ping(head)
+        return True
+
+    def _schedule_ping(self, contact: 'Contact'):
+        """
+        Queues a contact to be pinged. Pings are batched and sent by a background task,
+        so the insert that triggered them does not wait on the network.
+        """
+        if self.our_contact is None or self._closed or contact.id in self._pinging:
+            return
+        self._stale[contact.id] = contact
+        if self._ping_task is None or self._ping_task.done():
+            self._ping_task = asyncio.create_task(self._ping_stale_contacts())
+
+    async def _ping_stale_contacts(self):
+        """
+        Pings the queued contacts concurrently, off the lock. Contacts that answer are refreshed,
+        the others are evicted in favour of their bucket's most recently seen replacement.
+        """
+        while self._stale:
+            # Let the inserts of the current burst queue up their contacts first
+            await asyncio.sleep(0)
+            batch = list(self._stale.values())
+            self._stale.clear()
+            self._pinging.update(c.id for c in batch)
 
-                        # add new buckets to our bucket list
-                        self._buckets[index] = k1
-                        self._buckets.insert(index+1, k2)
-                        self._buckets[index].touch()
-                        self._buckets[index+1].touch()
+            logger.info(f">>> Pinging {len(batch)} stale contacts.")
+            try:
+                errors = await asyncio.gather(*(c.protocol.ping(self.our_contact) for c in batch), return_exceptions=True)
+            finally:
+                self._pinging.difference_update(c.id for c in batch)
 
-                        # Try adding the contact again, after splitting
+            if self._closed:
+                return
+
+            async with self.lock:
+                for contact, error in zip(batch, errors):
+                    kbucket = self.get_kbucket(contact.id)
+                    if not kbucket.contains(contact.id):
                         continue
+                    # Our own endpoint going away says nothing about the contact
+                    if isinstance(error, (asyncio.CancelledError, ConnectionError)):
+                        continue
+                    if isinstance(error, BaseException) or error.has_error():
+                        self._evict(kbucket, contact)
                     else:
-                        pass
-                        # TODO ping oldest contact to see if its still around and replace if not
-                        return
-                else:
-                    kbucket.add_contact(contact)
-                    return
+                        contact.touch()
+                        kbucket.replace_contact(contact)
+
+    def close(self):
+        """
+        Stops checking stale contacts. Pings in flight are cancelled, their contacts are kept.
+        """
+        self._closed = True
+        self._stale.clear()
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+
+    async def evict(self, contact: 'Contact') -> bool:
+        """
+        Evicts a contact that stopped responding. Returns False if it was not in its bucket.
+        """
+        async with self.lock:
+            kbucket = self.get_kbucket(contact.id)
+            if not kbucket.contains(contact.id):
+                return False
+            self._evict(kbucket, contact)
+            return True
+
+    def _evict(self, kbucket: KBucket, contact: 'Contact'):
+        """
+        Removes a contact from its bucket and promotes the most recently seen replacement.
+        """
+        kbucket.remove_contact(contact.id)
+        logger.info(f">>> Evicted contact: {contact}")
+        replacement = kbucket.pop_replacement()
+        if replacement is not None:
+            kbucket.add_contact(replacement)
 
     def can_split(self, kbucket: KBucket):
             return kbucket.has_in_range(self.id) or (kbucket.depth() % B_VAL) != 0
@@ -70,23 +201,67 @@ class BucketList:
 
     def get_kbucket_index(self, key) -> int | None:
         """
-        Find the appropriate k bucket for the given id.
+        Find the appropriate k bucket for the given id, by binary search over the bucket lower bounds.
         """
-        for i, bucket in enumerate(self._buckets):
-            if bucket.has_in_range(key):
-                return i
+        i = bisect.bisect_right(self._lows, key) - 1
+        if i >= 0 and self._buckets[i].has_in_range(key):
+            return i
+        return None
 
     async def get_close_contacts(self, key, our_id) -> list['Contact']:
         """"
         Get at most k contacts in the bucket that are closest the given id.
+        Buckets are visited from the key's bucket outward, and the walk stops once no remaining
+        bucket can hold a contact closer than the k closest found so far.
+        Contacts whose circuit is open are skipped.
         """
         async with self.lock:
-            contacts = [c for b in self._buckets for c in b.contacts if c.id != our_id]
-            return sorted(contacts, key=lambda c: c.id ^ key)[:K_VAL]
+            # Max heap of (-distance, id, contact) with the k closest contacts seen so far
+            closest: list[tuple[int, int, 'Contact']] = []
+
+            for bound, bucket in self._buckets_by_distance(key):
+                if len(closest) == K_VAL and bound >= -closest[0][0]:
+                    break
+                for c in bucket.contacts:
+                    if c.id == our_id or c.circuit_open:
+                        continue
+                    entry = (-(c.id ^ key), c.id, c)
+                    if len(closest) < K_VAL:
+                        heapq.heappush(closest, entry)
+                    elif entry > closest[0]:
+                        heapq.heapreplace(closest, entry)
+
+            return [c for _, _, c in sorted(closest, reverse=True)]
+
+    def _buckets_by_distance(self, key):
+        """
+        Yields (lower bound of the XOR distance to key, bucket) for every bucket, smallest bound first.
+
+        For ids above the key, the highest differing bit can only move up as the id grows, so a bucket
+        entirely above the key is at least 2**msb(low ^ key) away, and this grows with its position.
+        The same holds below the key with the high bound, so walking outward from the key's
+        bucket and merging both sides gives the buckets in order.
+        """
+        i = bisect.bisect_right(self._lows, key) - 1
+        left, right = i, i + 1
+
+        if i >= 0 and self._buckets[i].has_in_range(key):
+            yield 0, self._buckets[i]
+            left = i - 1
+
+        while left >= 0 or right < len(self._buckets):
+            left_bound = 1 << ((self._buckets[left].high ^ key).bit_length() - 1) if left >= 0 else None
+            right_bound = 1 << ((self._buckets[right].low ^ key).bit_length() - 1) if right < len(self._buckets) else None
+
+            if right_bound is None or (left_bound is not None and left_bound <= right_bound):
+                yield left_bound, self._buckets[left]
+                left -= 1
+            else:
+                yield right_bound, self._buckets[right]
+                right += 1
 
     def get_num_contacts(self) -> int:
-        cs = [c for b in self._buckets for c in b.contacts]
-        return len(cs)
+        return sum(len(b) for b in self._buckets)
 
     @property
     def buckets(self):
@@ -95,6 +270,7 @@ class BucketList:
     @buckets.setter
     def buckets(self, value):
         self._buckets = value
+        self._lows = [b.low for b in value]
 
     def __eq__(self, other):
         if not isinstance(other, BucketList):
@@ -1,16 +1,35 @@
 import json
+import sys
+import time
 
 from hermes.kademlia.Protocol import Protocol
-import datetime
-from dataclasses import dataclass, asdict
+from hermes.kademlia.Support import REQUEST_TIMEOUT, RETRANSMIT_TIMEOUT, RTT_ALPHA, RTT_BETA, MIN_RTO, RETRANSMIT_TRIES, \
+    CIRCUIT_FAILURES, CIRCUIT_RESET_TIMEOUT
+from dataclasses import dataclass, asdict, field
 
-@dataclass
+@dataclass(slots=True, weakref_slot=True, eq=False)
 class Contact:
     protocol: Protocol
     id: int
     host: str = ""
     port: int = 0
-    last_seen = datetime.datetime.now()
+    # Monotonic clock reading of the last time we heard from the peer
+    last_seen: float = field(default_factory=time.monotonic)
+    # Smoothed round trip time and its variation in seconds, None until measured
+    srtt: float | None = None
+    rttvar: float | None = None
+    # Consecutive failed requests, and monotonic clock reading of when they opened the circuit
+    failures: int = 0
+    opened_at: float | None = None
+    # Monotonic clock reading of when the request probing a half open circuit was let through
+    probe_at: float | None = None
+
+    def __post_init__(self):
+        # Many peers share a host, keep a single copy of the string
+        if isinstance(self.host, str):
+            self.host = sys.intern(self.host)
+        if isinstance(self.protocol, Protocol):
+            self.protocol.bind(self)
 
     def to_json(self) -> str:
         return json.dumps(asdict(self))
@@ -20,7 +39,76 @@ class Contact:
         return cls(**json.loads(json_str))
 
     def touch(self):
-        self.last_seen = datetime.datetime.now()
+        self.last_seen = time.monotonic()
+
+    def update_rtt(self, sample: float):
+        """
+        Folds a round trip time sample, in seconds, into the smoothed estimate and its variation.
+        """
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        """
+        Counts a failed request. The circuit opens after CIRCUIT_FAILURES in a row, and opens again
+        if the request probing it fails.
+        """
+        self.failures += 1
+        if self.probe_at is not None or (self.opened_at is None and self.failures >= CIRCUIT_FAILURES):
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+
+    @property
+    def circuit_open(self) -> bool:
+        """
+        Whether requests to the peer should be skipped. Once CIRCUIT_RESET_TIMEOUT passed the circuit is
+        half open: it lets a single probe through, and stays open to everyone else until the probe's outcome
+        is known, or REQUEST_TIMEOUT passed without it.
+        """
+        if self.opened_at is None:
+            return False
+        now = time.monotonic()
+        if now - self.opened_at < CIRCUIT_RESET_TIMEOUT:
+            return True
+        return self.probe_at is not None and now - self.probe_at < REQUEST_TIMEOUT
+
+    def try_request(self) -> bool:
+        """
+        Returns whether a request may be sent to the peer. A request let through a half open circuit
+        is its probe.
+        """
+        if self.circuit_open:
+            return False
+        if self.opened_at is not None:
+            self.probe_at = time.monotonic()
+        return True
+
+    @property
+    def rto(self) -> float:
+        """
+        Seconds to wait for an answer from the peer before retransmitting.
+        """
+        if self.srtt is None:
+            return RETRANSMIT_TIMEOUT
+        return min(max(self.srtt + 4 * self.rttvar, MIN_RTO), REQUEST_TIMEOUT)
+
+    @property
+    def timeout(self) -> float:
+        """
+        Seconds to wait for an answer from the peer, retransmissions included, before giving up.
+        """
+        if self.srtt is None:
+            return REQUEST_TIMEOUT
+        return min(self.rto * (2 ** (RETRANSMIT_TRIES + 1) - 1), REQUEST_TIMEOUT)
 
     def __repr__(self):
         return f"ID: {self.id} ~ HOST: {self.host} ~ PORT: {self.port} Last Seen: {self.last_seen}"
@@ -28,4 +116,7 @@ class Contact:
     def __eq__(self, other):
         if not isinstance(other, Contact):
             return NotImplemented
-        return self.id == other.id
\ No newline at end of file
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
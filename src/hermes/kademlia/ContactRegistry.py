@@ -0,0 +1,70 @@
+import sys
+import weakref
+
+from collections import OrderedDict
+from typing import Callable
+
+from hermes.kademlia.Contact import Contact
+from hermes.kademlia.Protocol import Protocol
+from hermes.kademlia.Support import FAILING_CONTACTS
+
+class ContactRegistry:
+    '''
+    Interns contacts by id, so a peer is the same object across buckets, lookups and messages.
+    Only weak references are held: a peer is forgotten once nothing else refers to it, unless its
+    last requests failed, so that its circuit state carries over to the next lookup that finds it.
+    '''
+
+    def __init__(self, max_failing: int = FAILING_CONTACTS):
+        self._contacts: weakref.WeakValueDictionary[int, Contact] = weakref.WeakValueDictionary()
+        # Failing contacts, least recently failed first
+        self._failing: OrderedDict[int, Contact] = OrderedDict()
+        self._max_failing = max_failing
+
+    def intern(self, id: int, host: str, port: int, protocol_factory: Callable[[str, int], Protocol],
+               update_address: bool = False) -> Contact:
+        """
+        Returns the contact registered for the id, creating it if needed.
+
+        Args:
+            protocol_factory: Builds the protocol of a new contact from its address.
+            update_address: Move a known contact to the given address. Only set when the
+                address comes from the peer itself, not from a third party.
+        """
+        contact = self._contacts.get(id)
+
+        if contact is None:
+            contact = Contact(protocol_factory(host, port), id, host, port)
+            self._contacts[id] = contact
+        elif update_address and (contact.host != host or contact.port != port):
+            contact.host = sys.intern(host)
+            contact.port = port
+            contact.protocol = protocol_factory(host, port)
+            contact.protocol.bind(contact)
+
+        return contact
+
+    def update(self, contact: Contact):
+        """
+        Keeps a registered contact alive while it has failures, and lets it go once it answers again.
+        """
+        if self._contacts.get(contact.id) is not contact:
+            return
+
+        if contact.failures == 0:
+            self._failing.pop(contact.id, None)
+            return
+
+        self._failing[contact.id] = contact
+        self._failing.move_to_end(contact.id)
+        if len(self._failing) > self._max_failing:
+            self._failing.popitem(last=False)
+
+    def get(self, id: int) -> Contact | None:
+        return self._contacts.get(id)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._contacts
+
+    def __len__(self) -> int:
+        return len(self._contacts)
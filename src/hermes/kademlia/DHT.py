@@ -1,5 +1,9 @@
+import asyncio
+import logging
 import random
 
+from typing import Awaitable, Callable, Iterable
+
 from hermes.kademlia.KBucket import KBucket
 from hermes.kademlia.Protocol import Protocol
 from hermes.kademlia.Contact import Contact
@@ -8,12 +12,21 @@ from hermes.kademlia.Storage import Storage
 from hermes.kademlia.Router import Router
 from hermes.kademlia.Node import Node
 from hermes.net.UDPServer import UDPServer
-from hermes.kademlia.Support import BUCKET_REFRESH_INTERVAL
+from hermes.net.UDPClient import UDPClient
+from hermes.net.RateLimiter import RateLimiter
+from hermes.net.ServerPool import ServerPool
+from hermes.kademlia.Support import BUCKET_REFRESH_INTERVAL, WRITE_QUORUM, REFRESH_CONCURRENCY, READY_CONTACTS, \
+    MAINTENANCE_INTERVAL, MAINTENANCE_JITTER, REFRESH_BUDGET, EVICTION_FAILURES
 
 import datetime
 
+logger = logging.getLogger(__name__)
+
 class DHT:
-    def __init__(self, id: int, protocol: Protocol, storage: Storage, local_addr: tuple[str, int] = ('0.0.0.0', 3301)):
+    def __init__(self, id: int, protocol: Protocol, storage: Storage, local_addr: tuple[str, int] = ('0.0.0.0', 3301),
+                 rate_limiter: RateLimiter = None, write_quorum: int = WRITE_QUORUM,
+                 ready_contacts: int = READY_CONTACTS, refresh_interval: float = BUCKET_REFRESH_INTERVAL,
+                 maintenance_interval: float = MAINTENANCE_INTERVAL, refresh_budget: int = REFRESH_BUDGET):
         self._storage: Storage = storage
         self._protocol:Protocol = protocol
         self._our_id: int = id
@@ -21,8 +34,26 @@ class DHT:
         self._node: Node = Node(self._our_contact, storage)
         self._router: Router = Router(self._node)
         self._router.set_error_handler(self.handle_error)
-        #UDP server
-        self._server = UDPServer(self._node, self._our_contact.host, self._our_contact.port)
+        # Single endpoint for all of our outgoing RPCs
+        self._client = UDPClient()
+        #UDP server, limiting the requests of every source
+        self._server = UDPServer(self._node, self._our_contact.host, self._our_contact.port, self._client,
+                                 rate_limiter=rate_limiter if rate_limiter is not None else RateLimiter())
+        self._pool: ServerPool | None = None
+        # Acknowledgements a store waits for, and the stores still running after it returned
+        self._write_quorum: int = write_quorum
+        self._background: set[asyncio.Task] = set()
+        # Set once the routing table holds ready_contacts contacts, or bootstrapping from a seed is over
+        self._ready_contacts: int = ready_contacts
+        self._ready = asyncio.Event()
+        self._bootstrapped = asyncio.Event()
+        # Refreshes the buckets gone refresh_interval milliseconds without a lookup
+        self._refresh_interval: float = refresh_interval
+        self._maintenance_interval: float = maintenance_interval
+        self._refresh_budget: int = refresh_budget
+        self._maintenance: asyncio.Task | None = None
+        # Lookups in flight by (key, kind), shared by every caller asking for the same one
+        self._lookups: dict[tuple[int, str], asyncio.Task] = {}
 
     def _set_addr_in_contact(self, addr: tuple[str, int]):
         self._our_contact.host = addr[0]
@@ -30,19 +61,47 @@ class DHT:
         self._server.port = addr[1]
         self._server.host = addr[0]
 
-    async def start(self):
-        await self._server.start(self._set_addr_in_contact)
+    async def start(self, processes: int = 1):
+        """
+        Starts serving and refreshing stale buckets. With more than one process, the extra processes share
+        the port through SO_REUSEPORT and answer lookups from a replica of the routing table and storage.
+        """
+        await self._server.start(self._set_addr_in_contact, reuse_port=processes > 1)
+        if processes > 1:
+            self._pool = ServerPool(self._node, self._our_contact.host, self._our_contact.port, processes - 1,
+                                    self._client, workers=self._server.workers, queue_size=self._server.queue_size,
+                                    rate_limiter=self._server.rate_limiter, compression=self._server.compression)
+            await self._pool.start()
+        self._maintenance = asyncio.create_task(self._maintain())
 
     async def stop(self):
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            try:
+                await self._maintenance
+            except asyncio.CancelledError:
+                pass
+            self._maintenance = None
+        for task in list(self._background) + list(self._lookups.values()):
+            task.cancel()
+        # Before closing the client, which would fail the pings in flight
+        self._node.bucket_list.close()
+        if self._pool is not None:
+            await self._pool.stop()
+            self._pool = None
         await self._server.stop()
+        self._client.close()
 
-    async def store(self, key: int, val: str):
+    async def store(self, key: int, val: str) -> bool:
         """
-        Store a key value pair on the DHT. (on K closer contacts
+        Store a key value pair on the DHT. (on K closer contacts, returning once the write quorum acknowledged)
+        Returns False if fewer than the write quorum of them acknowledged.
         """
-        self._touch_bucket_with_key(key)
         self._storage.set(key, val)
-        await self._store_on_closer_contacts(key, val)
+        stored = await self._store_on_closer_contacts(key, val)
+        # After, so the store still looks the key up if its bucket was stale
+        self._touch_bucket_with_key(key)
+        return stored
 
     async def find_value(self, key: int) -> (bool, list[Contact], str):
         self._touch_bucket_with_key(key)
@@ -56,84 +115,200 @@ class DHT:
         if self._storage.contains(key):
             ret = (True, None, self._storage.get(key))
         else:
-            found, contacts, found_by, val = await self._router.lookup(key, self.router.rpc_find_value)
+            ret = await self._coalesced(key, "value", self._find_remote_value)
+        return ret
 
-            if found:
-                ret = (True, None, val)
+    async def _find_remote_value(self, key: int) -> (bool, list[Contact], str):
+        found, contacts, found_by, val = await self._router.lookup(key, self.router.rpc_find_value)
 
-                # Cache the key in the node closest to the contact
-                store_to_candidates = sorted([c for c in contacts if c != found_by], key=lambda c: c.id ^ key)
+        if not found:
+            return False, None, None
 
-                if len(store_to_candidates) > 0:
-                    store_to = store_to_candidates[0]
-                    separating_nodes = self._get_separating_nodes_count(self._our_contact, store_to)
-                    error = await store_to.protocol.store(self._node.our_contact, key, val, BUCKET_REFRESH_INTERVAL)
-                    self.handle_error(error, store_to)
-        return ret
+        # Cache the key in the node closest to the contact
+        store_to_candidates = sorted([c for c in contacts if c != found_by], key=lambda c: c.id ^ key)
+
+        if len(store_to_candidates) > 0:
+            store_to = store_to_candidates[0]
+            separating_nodes = self._get_separating_nodes_count(self._our_contact, store_to)
+            error = await store_to.protocol.store(self._node.our_contact, key, val, BUCKET_REFRESH_INTERVAL)
+            self.handle_error(error, store_to)
+        return True, None, val
+
+    async def _coalesced(self, key: int, kind: str, lookup: Callable[[int], Awaitable]):
+        """
+        Runs lookup(key), unless a lookup of the same kind for the key is already in flight,
+        in which case its result is shared instead.
+        """
+        flight = self._lookups.get((key, kind))
+        if flight is None:
+            flight = asyncio.create_task(lookup(key))
+            self._lookups[(key, kind)] = flight
+            flight.add_done_callback(lambda _: self._lookups.pop((key, kind), None))
+        # A caller giving up does not cancel the lookup for the others
+        return await asyncio.shield(flight)
 
     def _touch_bucket_with_key(self, key):
-        pass
+        self._node.bucket_list.get_kbucket(key).touch()
 
-    async def _store_on_closer_contacts(self, key:  int, val: str) -> None:
+    async def _store_on_closer_contacts(self, key:  int, val: str) -> bool:
         now: datetime = datetime.datetime.now()
 
         kbucket = self._node.bucket_list.get_kbucket(key)
         contacts = []
 
-        if (now - kbucket.timestamp).total_seconds()*1000 < BUCKET_REFRESH_INTERVAL:
+        if (now - kbucket.timestamp).total_seconds()*1000 < self._refresh_interval:
             contacts = await self._node.bucket_list.get_close_contacts(key, self._node.our_contact.id)
         else:
-            found, contacts, found_by, val = await self.router.lookup(key, self._router.rpc_find_nodes)
+            _, contacts, _, _ = await self._coalesced(key, "node",
+                                                      lambda k: self.router.lookup(k, self._router.rpc_find_nodes))
 
-        for c in list(contacts):
-            error = await c.protocol.store(self._node.our_contact, key, val)
-            self.handle_error(error, c)
+        return await self._store_on(list(contacts), key, val)
 
-    async def bootstrap(self, known_peer: Contact):
+    async def _store_on(self, contacts: list[Contact], key: int, val: str) -> bool:
         """
-        bootstrap our peer by contacting another, adding its contacts to our list, then getting the contacts
-        for other peers not in the bucket range of our known peer we're joining.
+        Sends the STORE to all contacts at once and returns whether the write quorum acknowledged, as soon
+        as it did or can no longer do so. Fewer contacts than the quorum can never make it.
         """
-        error: RPCError
-        contacts: list[Contact] = []
-
-        # Add known peer to our contacts
-        await self._node.bucket_list.add_contact(known_peer)
-        # Send RPC to known peer to add ourselves to many peers and to get their information ourselves
-        contacts, error = await known_peer.protocol.find_node(self._our_contact, self._our_id)
-        self.handle_error(error, known_peer)
-
-        if not error.has_error():
-            for contact in list(contacts):
-                # Add the returned peers to our contacts
-                await self._node.bucket_list.add_contact(contact)
-
+        async def store(contact: Contact) -> bool:
+            try:
+                error = await contact.protocol.store(self._node.our_contact, key, val)
+            except Exception as e:
+                error = RPCError(protocol_error=True, protocol_error_message=str(e))
+            self.handle_error(error, contact)
+            return not error.has_error()
+
+        pending = {asyncio.create_task(store(c)) for c in contacts if c.try_request()}
+        acks = 0
+        while pending and self._write_quorum - len(pending) <= acks < self._write_quorum:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            acks += sum(1 for t in done if t.result())
+
+        # Stragglers, or every replica when too few were reachable, report through handle_error when they complete
+        for task in pending:
+            self._track(task)
+        return acks >= self._write_quorum
+
+    def _track(self, task: asyncio.Task):
+        """
+        Keeps a background task referenced until it is done, and logs it if it failed.
+        """
+        def done(task: asyncio.Task):
+            self._background.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"Background task failed: {str(task.exception())}")
 
-            # Refresh the other buckets (not containing the known peer bucket) to expand our network
-            known_peer_bucket: KBucket = self._node.bucket_list.get_kbucket(known_peer.id)
-            other_buckets = [b for b in self._node.bucket_list.buckets if b != known_peer_bucket]
+        self._background.add(task)
+        task.add_done_callback(done)
 
-            for other_bucket in other_buckets:
-                await self._refresh_bucket(other_bucket)
+    async def bootstrap(self, seeds: Contact | Iterable[Contact]) -> RPCError:
+        """
+        bootstrap our peer by contacting one or more others at once, adding their contacts to our list, then
+        refreshing the buckets not in the bucket range of the seeds through lookups, REFRESH_CONCURRENCY at a time.
+        Returns the error of the last seed if none of them answered.
+        """
+        seeds = [seeds] if isinstance(seeds, Contact) else list(seeds)
+        self._bootstrapped.clear()
+
+        # Add the seeds to our contacts
+        await self._node.bucket_list.add_contacts(seeds)
+
+        # Send RPCs to the seeds to add ourselves to many peers and to get their information ourselves
+        async def join(seed: Contact) -> RPCError:
+            contacts, error = await seed.protocol.find_node(self._our_contact, self._our_id)
+            self.handle_error(error, seed)
+            if not error.has_error():
+                await self._node.bucket_list.add_contacts(contacts)
+                self._check_ready()
+            return error
+
+        errors: list[RPCError] = await asyncio.gather(*(join(seed) for seed in seeds))
+        joined = [seed for seed, error in zip(seeds, errors) if not error.has_error()]
+
+        try:
+            if not joined:
+                return errors[-1] if errors else RPCError(protocol_error=True,
+                                                          protocol_error_message="No seed to bootstrap from.")
+
+            # Refresh the other buckets (not containing a seed) to expand our network
+            seed_buckets = [self._node.bucket_list.get_kbucket(seed.id) for seed in joined]
+            other_buckets = [b for b in self._node.bucket_list.buckets if b not in seed_buckets]
+
+            await self._refresh_buckets(other_buckets)
+            return RPCError()
+        finally:
+            # The routing table will not fill any further, let waiting clients go
+            if joined:
+                self._ready.set()
+            self._bootstrapped.set()
+
+    async def wait_ready(self, timeout: float | None = None) -> bool:
+        """
+        Waits until the routing table holds enough contacts to serve, or bootstrapping is over.
+        Returns False if the timeout expired first, or if no seed could be joined.
+        """
+        waits = {asyncio.create_task(self._ready.wait()), asyncio.create_task(self._bootstrapped.wait())}
+        _, pending = await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        return self._ready.is_set()
 
-        return error
+    def _check_ready(self):
+        if self._node.bucket_list.get_num_contacts() >= self._ready_contacts:
+            self._ready.set()
 
     async def _refresh_bucket(self, bucket: KBucket):
         """
-        do an RPC for a random ID in the bucket to discover more peers
+        Look up a random ID in the bucket to discover more peers
         """
         bucket.touch()
         # Pick a random ID to query
         rand_id = self._random_id_in_bucket(bucket)
-        contacts: list[Contact] = list(bucket.contacts)
 
-        for contact in list(contacts):
-            # Discover more peers
-            (new_contacts, timeout_error) = await contact.protocol.find_node(self._our_contact, rand_id)
-            self.handle_error(timeout_error, contact)
-            for nc in list(new_contacts):
-                # Add new peers
-                await self._node.bucket_list.add_contact(nc)
+        # Add the peers that answered the lookup
+        _, contacts, _, _ = await self._router.lookup(rand_id, self._router.rpc_find_nodes, give_all=True)
+        await self._node.bucket_list.add_contacts(contacts)
+        self._check_ready()
+
+    async def _maintain(self):
+        while True:
+            jitter = random.uniform(-MAINTENANCE_JITTER, MAINTENANCE_JITTER)
+            await asyncio.sleep(self._maintenance_interval * (1 + jitter))
+            try:
+                refreshed = await self.refresh_stale_buckets()
+                if refreshed:
+                    logger.info(f"Refreshed {refreshed} stale buckets")
+            except Exception as e:
+                logger.error(f"Bucket refresh failed: {str(e)}")
+
+    def stale_buckets(self) -> list[KBucket]:
+        """
+        Returns the buckets without a lookup for refresh_interval milliseconds, least recently refreshed first.
+        """
+        now = datetime.datetime.now()
+        stale = [b for b in self._node.bucket_list.buckets
+                 if (now - b.timestamp).total_seconds()*1000 >= self._refresh_interval]
+        return sorted(stale, key=lambda b: b.timestamp)
+
+    async def refresh_stale_buckets(self) -> int:
+        """
+        Refreshes at most refresh_budget stale buckets, REFRESH_CONCURRENCY at a time,
+        and returns how many were refreshed.
+        """
+        if self._node.bucket_list.get_num_contacts() == 0:
+            return 0
+
+        buckets = self.stale_buckets()[:self._refresh_budget]
+        await self._refresh_buckets(buckets)
+        return len(buckets)
+
+    async def _refresh_buckets(self, buckets: list[KBucket]):
+        semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+        async def refresh(bucket: KBucket):
+            async with semaphore:
+                await self._refresh_bucket(bucket)
+
+        await asyncio.gather(*(refresh(b) for b in buckets))
 
     def _random_id_in_bucket(self, bucket: KBucket):
         return random.randint(bucket.low, bucket.high)
@@ -142,7 +317,24 @@ class DHT:
         return 0
 
     def handle_error(self, error: RPCError, contact: Contact):
-        pass
+        """
+        Records the outcome of a request to a contact. Contacts failing EVICTION_FAILURES times in a row
+        are evicted from their bucket, which promotes a replacement.
+        """
+        if error is None or contact is None or contact.id == self._our_id:
+            return
+
+        # A peer answering with an error is still alive
+        if not error.has_error() or error.peer_error:
+            contact.record_success()
+            self._client.contacts.update(contact)
+            return
+
+        contact.record_failure()
+        self._client.contacts.update(contact)
+        if contact.failures >= EVICTION_FAILURES:
+            logger.info(f"Evicting {contact.host}:{contact.port} after {contact.failures} failed requests")
+            self._track(asyncio.create_task(self._node.bucket_list.evict(contact)))
 
     @property
     def protocol(self):
@@ -152,6 +344,10 @@ class DHT:
     def storage(self):
         return self._storage
 
+    @property
+    def client(self):
+        return self._client
+
     @property
     def contact(self):
         return self._our_contact
@@ -164,6 +360,10 @@ class DHT:
     def router(self, value):
         self._router = value
 
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
     @property
     def our_id(self):
         return self._our_id
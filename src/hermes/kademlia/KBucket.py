@@ -3,19 +3,28 @@ from __future__ import annotations
 import datetime
 import logging
 
+from collections import OrderedDict
+
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from hermes.kademlia.Contact import Contact
 
-from hermes.kademlia.Support import K_VAL
+from hermes.kademlia.Support import K_VAL, REPLACEMENT_CACHE_SIZE, ID_BITS
 
 logger = logging.getLogger(__name__)
 
 class KBucket:
     def __init__(self, low=None, high=None):
         self.timestamp: datetime = datetime.datetime.now()
-        self._contacts: list['Contact'] = []
+        # Contacts by id, from least to most recently seen
+        self._contacts: OrderedDict[int, 'Contact'] = OrderedDict()
+        # Candidates seen while the bucket was full, from least to most recently seen
+        self._replacements: OrderedDict[int, 'Contact'] = OrderedDict()
+        # Smallest and largest contact ids, from which the depth is derived
+        self._min_id: int | None = None
+        self._max_id: int | None = None
+        self._depth: int = 0
         if low is not None and high is not None:
             self._low = low
             self._high = high
@@ -45,9 +54,29 @@ class KBucket:
         """
         if len(self._contacts)  >= K_VAL:
             raise Exception("KBucket is full")
-        self._contacts.append(contact)
+        self._contacts[contact.id] = contact
+        self._replacements.pop(contact.id, None)
+        self._track(contact.id)
         logger.info(">>> Added contact: " + str(contact))
 
+    def add_replacement(self, contact: 'Contact'):
+        """
+        Remembers a contact that did not fit in the full bucket, dropping the least
+        recently seen replacement if the cache is full.
+        """
+        self._replacements[contact.id] = contact
+        self._replacements.move_to_end(contact.id)
+        if len(self._replacements) > REPLACEMENT_CACHE_SIZE:
+            self._replacements.popitem(last=False)
+
+    def pop_replacement(self) -> Contact | None:
+        """
+        Removes and returns the most recently seen replacement, if any.
+        """
+        if not self._replacements:
+            return None
+        return self._replacements.popitem()[1]
+
     def contains(self, id):
         """
         Checks if a contact with a given ID is already present in the bucket.
@@ -55,20 +84,31 @@ class KBucket:
         Args:
             id: The ID of the contact to be searched for.
         """
-        for contact in self._contacts:
-            if contact.id == id:
-                return True
-        return False
+        return id in self._contacts
 
     def replace_contact(self, new_contact):
         """
-        Replaces the contact with the same id in the bucket with the new contact.
-        Used to update network info and LastSeen values.
+        Replaces the contact with the same id in the bucket with the new contact, and moves
+        it to the most recently seen end. Used to update network info and LastSeen values.
+        """
+        if new_contact.id in self._contacts:
+            self._contacts[new_contact.id] = new_contact
+            self._contacts.move_to_end(new_contact.id)
+
+    def remove_contact(self, id) -> Contact | None:
+        """
+        Removes the contact with the given id from the bucket and returns it, if present.
         """
-        for i, contact in enumerate(self._contacts):
-            if contact.id == new_contact.id:
-                self._contacts[i] = new_contact
-                return
+        contact = self._contacts.pop(id, None)
+        if contact is not None and id in (self._min_id, self._max_id):
+            self._recompute_depth()
+        return contact
+
+    def head(self) -> Contact | None:
+        """
+        Returns the least recently seen contact, which is the first candidate for eviction.
+        """
+        return next(iter(self._contacts.values()), None)
 
     def split(self) -> (KBucket, KBucket):
         """
@@ -83,12 +123,17 @@ class KBucket:
         k1 = KBucket(self._low, mid)
         k2 = KBucket(mid + 1, self._high)
 
-        # Reorganize the contacts into the new kbuckets
-        for contact in list(self._contacts):
-            if k1.low <= contact.id <= k1.high:
-                k1.add_contact(contact)
+        # Reorganize the contacts into the new kbuckets, keeping their recently seen order.
+        # Each half holds a subset of a bucket that fit, so there is no need to check capacity.
+        for id, contact in self._contacts.items():
+            k = k1 if id <= mid else k2
+            k._contacts[id] = contact
+            k._track(id)
+        for id, contact in self._replacements.items():
+            if id <= mid:
+                k1._replacements[id] = contact
             else:
-                k2.add_contact(contact)
+                k2._replacements[id] = contact
         return k1, k2
 
     def has_in_range(self, id):
@@ -96,28 +141,26 @@ class KBucket:
 
     def depth(self) -> int:
         """
-        Find the number of common bits among all contacts
-        If no contacts, or shared bits, return 0
+        Find the number of leading bits shared by all contact ids, compared at a fixed width of ID_BITS.
+        All ids between the smallest and largest one share their common prefix, so it is the
+        common prefix of those two. If no contacts, return 0
         """
+        return self._depth
 
-        # Create a list of bit strings of all contact ids
-        bits: list[str] = [str(bin(contact.id))[2:] for contact in self._contacts]
-        shared_bits: str = ''
-
-        if len(self._contacts) > 0:
-            # Start at first contact
-            shared_bits = bits[0]
-
-            # Loop through all other contacts
-            for i in range(1, len(bits)):
-                # Loop through shared bits
-                for j in range(len(shared_bits)):
-                    # When bits start mismatching, stop and update shared_bits to just before that
-                    if shared_bits[j] != bits[i][j]:
-                        shared_bits = shared_bits[:i]
-                        break
+    def _track(self, id: int):
+        """
+        Updates the cached id bounds and depth for an added id.
+        """
+        self._min_id = id if self._min_id is None else min(self._min_id, id)
+        self._max_id = id if self._max_id is None else max(self._max_id, id)
+        width = max(ID_BITS, self._max_id.bit_length())
+        self._depth = width - (self._min_id ^ self._max_id).bit_length()
 
-        return len(shared_bits)
+    def _recompute_depth(self):
+        self._min_id = self._max_id = None
+        self._depth = 0
+        for id in self._contacts:
+            self._track(id)
 
     def is_full(self):
         """
@@ -125,13 +168,21 @@ class KBucket:
         """
         return len(self._contacts) == K_VAL
 
+    def __len__(self):
+        return len(self._contacts)
+
     @property
-    def contacts(self):
-        return self._contacts
+    def contacts(self) -> list['Contact']:
+        return list(self._contacts.values())
 
     @contacts.setter
     def contacts(self, value):
-        self._contacts = value
+        self._contacts = OrderedDict((c.id, c) for c in value)
+        self._recompute_depth()
+
+    @property
+    def replacements(self) -> list['Contact']:
+        return list(self._replacements.values())
 
     @property
     def low(self):
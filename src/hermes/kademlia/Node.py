@@ -12,7 +12,7 @@ class Node:
     def __init__(self, our_contact: 'Contact', storage: Storage):
         self._our_contact = our_contact
         self._storage: Storage = storage
-        self._bucket_list: BucketList = BucketList(our_contact.id)
+        self._bucket_list: BucketList = BucketList(our_contact.id, our_contact)
 
     def ping(self, sender):
         return self._our_contact
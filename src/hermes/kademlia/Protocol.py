@@ -8,10 +8,18 @@ from hermes.kademlia.RPCError import RPCError
 from hermes.kademlia.Support import BUCKET_REFRESH_INTERVAL
 
 class Protocol:
+    __slots__ = ('_responds', '_node')
+
     def __init__(self, responds: bool = True, node: 'Node' = None):
         self._responds = responds
         self._node = node
 
+    def bind(self, contact: 'Contact'):
+        """
+        Called with the contact this protocol reaches.
+        """
+        pass
+
     async def store(self, sender: 'Contact', key: int, val: str, exp_time: int = BUCKET_REFRESH_INTERVAL) -> RPCError:
         """
         Stores the value on the remote peer.
@@ -35,7 +43,7 @@ class Protocol:
             self._node.ping(sender)
         err = RPCError()
         err.timeout_error = False if self._responds else True
-        return RPCError()
+        return err
 
     def no_error(self):
         return RPCError()
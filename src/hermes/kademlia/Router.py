@@ -7,6 +7,7 @@ from hermes.kademlia.KBucket import KBucket
 from hermes.kademlia.Node import Node
 from hermes.kademlia.Contact import Contact
 from hermes.kademlia.RPCError import RPCError
+from hermes.kademlia.Shortlist import Shortlist
 from hermes.kademlia.Support import K_VAL
 from hermes.kademlia.Support import A_VAL
 
@@ -18,87 +19,32 @@ class Router:
     def __init__(self, node: Node):
         self.node: Node = node
         self.error_handler: Callable[[RPCError, Contact], None] = lambda e, c: None
-        self.lock = asyncio.Lock()
 
 
     async def lookup(self, key: int,
-                     rpc_call: Callable[[int, Contact], tuple[list[Contact], Contact, str]],
+                     rpc_call: Callable[[int, Contact], tuple[list[Contact], Contact, str, RPCError]],
                      give_all: bool = False) -> (bool, list[Contact], Contact, str):
 
         """
         Node lookup algorithm for finding the closest nodes to the given key and they target itself if possible.
+        Keeps up to A_VAL RPCs in flight, starting a new one as soon as any of them returns.
+        The bucket of the key is touched, it does not need a refresh for a while.
         """
+        our_id = self.node.our_contact.id
+        self.node.bucket_list.get_kbucket(key).touch()
 
-        ret: list[Contact] = []
-        have_work = True
+        shortlist = Shortlist(key, K_VAL, exclude=(our_id,))
+        shortlist.extend(await self.node.bucket_list.get_close_contacts(key, our_id))
 
-        all_nodes: list[Contact] = self.node.bucket_list.get_kbucket(key).contacts
+        found, found_by, val = await self.query(key, shortlist, rpc_call)
 
-        nodes_to_query: list[Contact] = all_nodes[:A_VAL]
-
-        # Split contacts into two groups
-        closer_contacts: list[Contact] = [node for node in nodes_to_query if node.id ^ key < self.node.our_contact.id ^ key]
-        farther_contacts: list[Contact] = [node for node in nodes_to_query if
-                                           node.id ^ key >= self.node.our_contact.id ^ key]
-
-        # Keep track of distinct nodes that have been contacted
-        contacted_ids: set[int] = {n.id for n in nodes_to_query}
-        contacted_Nodes: list[Contact] = nodes_to_query
-
-        # Initial query attempt
-        found, contacts, found_by, val = await self.query(key, nodes_to_query, rpc_call, closer_contacts, farther_contacts)
-
-        # If initial query resulted in a hit, we are done
         if found:
-            return found, contacts, found_by, val
-
-        # otherwise, continue and add the closer contacts to the return
-        ret.extend(c for c in closer_contacts if c.id not in {r.id for r in ret})
-
-        # Loop and continue to try and find the target until K nodes have been contacted or no one is left to query
-        while len(ret) < K_VAL and have_work:
-            # Find far and close nodes that have not been contacted
-            closer_uncontacted_nodes: list[Contact] = [c for c in closer_contacts if c not in contacted_Nodes]
-            farther_uncontacted_nodes: list[Contact] = [c for c in farther_contacts if c not in contacted_Nodes]
-
-            # Do we have nodes to contact?
-            have_closer: bool = len(closer_uncontacted_nodes) > 0
-            have_farther: bool = len(farther_uncontacted_nodes) > 0
-
-            # Do we REALLY have nodes to contact?
-            have_work = have_closer or have_farther
-
-            # Try close nodes first
-            if have_closer:
-                new_nodes_to_query = closer_uncontacted_nodes[:A_VAL]
-                contacted_Nodes.extend(n for n in new_nodes_to_query if n.id not in contacted_ids)
-                contacted_ids.update(n.id for n in new_nodes_to_query)
-
-                # Query again
-                found, contacts, found_by, val = await self.query(key, new_nodes_to_query, rpc_call, closer_contacts,
-                                                                  farther_contacts)
-
-                # Exit if we found the target
-                if found:
-                    return found, contacts, found_by, val
-
-            # Do the same for the far uncontacted nodes
-            elif have_farther:
-                new_nodes_to_query = farther_uncontacted_nodes[:A_VAL]
-                contacted_Nodes.extend(n for n in new_nodes_to_query if n.id not in contacted_ids)
-                contacted_ids.update(n.id for n in new_nodes_to_query)
-
-                # Query again
-                found, contacts, found_by, val = await self.query(key, new_nodes_to_query, rpc_call, closer_contacts,
-                                                                  farther_contacts)
-
-                if found:
-                    return found, contacts, found_by, val
+            return found, shortlist.closest(), found_by, val
 
         if give_all:
-            return False, ret, None, None
+            return False, shortlist.responded(), None, None
         else:
-            return False, sorted(ret, key=lambda c: c.id ^ key)[:K_VAL], None, None
+            return False, shortlist.closest(), None, None
 
     def get_closest_nonempty_kbucket(self, key: int) -> KBucket:
         """
@@ -119,15 +65,17 @@ class Router:
         """
         return sorted(bucket.contacts, key=lambda c: c.id ^ key)
 
-    async def rpc_find_nodes(self, key: int, contact: Contact) -> (list[Contact], Contact, str):
+    async def rpc_find_nodes(self, key: int, contact: Contact) -> (list[Contact], Contact, str, RPCError):
         """
         RPC to find nodes by key
         """
-        (new_contacts, timeout_err) = await contact.protocol.find_node(self.node.our_contact, key)
-        # TODO null continuation?
-        return new_contacts, None, None
+        (new_contacts, error) = await contact.protocol.find_node(self.node.our_contact, key)
+
+        self.error_handler(error, contact)
 
-    async def rpc_find_value(self, key: int, contact: Contact) -> (list[Contact], Contact, str):
+        return new_contacts, None, None, error
+
+    async def rpc_find_value(self, key: int, contact: Contact) -> (list[Contact], Contact, str, RPCError):
         """
         RPC to find value by key
         """
@@ -147,58 +95,71 @@ class Router:
                 nodes.append(contact)
                 ret_val = val
                 found_by = contact
-        return nodes, found_by, ret_val
+        return nodes, found_by, ret_val, error
 
     async def get_closer_nodes(self, key: int, node_to_query: Contact,
-                               rpc_call: Callable[[int, Contact], tuple[list[Contact], Contact, str]],
-                               close_contacts: list[Contact],
-                               farther_contacts: list[Contact]) -> tuple[bool, str, Contact | None]:
+                               rpc_call: Callable[[int, Contact], tuple[list[Contact], Contact, str, RPCError]],
+                               shortlist: Shortlist) -> tuple[bool, str, Contact | None]:
 
         """
-        Exclude ourselves and peers we are contacting, to get a unique list of peers
+        Query a node and add the peers it knows about to the shortlist.
+        The shortlist drops ourselves and peers it already holds.
 
         Returns
             found, value, found_by
         """
 
-        contacts, contact_found_by, found_val = await rpc_call(key, node_to_query)
-        val = found_val
-        found_by = contact_found_by
+        contacts, found_by, val, error = await rpc_call(key, node_to_query)
 
-        if len(contacts) == 0:
+        if error.has_error():
+            shortlist.mark_failed(node_to_query)
             return False, "", None
 
-        peers_nodes: list[Contact] = [
-            c for c in contacts if
-            c.id != self.node.our_contact.id and
-            c.id != node_to_query.id and
-            c not in close_contacts and
-            c not in farther_contacts
-        ]
-
-        nearest_node_distance = node_to_query.id ^ key
-
-        # Update contact lists
-        async with self.lock:
-            for peer in peers_nodes:
-                d = peer.id ^ key
-                target_list = close_contacts if d < nearest_node_distance else farther_contacts
-                if peer.id not in [c.id for c in target_list]:
-                    target_list.append(peer)
-
-        return val is not None, val, found_by
-
-    async def query(self, key: int, nodes_to_query: list[Contact],
-                    rpc_call: Callable[[int, Contact], tuple[list[Contact], Contact, str]],
-                    closer_contacts: list[Contact], farther_contacts: list[Contact]) -> (
-            bool, list[Contact], Contact, str):
-
-        for node in list(nodes_to_query):
-            found, val, found_by = await self.get_closer_nodes(key, node, rpc_call, closer_contacts, farther_contacts)
-            if found:
-                return found, closer_contacts, found_by, val
-
-        return False, None, None, ""
+        shortlist.mark_responded(node_to_query)
+
+        if val is not None:
+            return True, val, found_by
+
+        shortlist.extend(contacts)
+
+        return False, "", None
+
+    async def query(self, key: int, shortlist: Shortlist,
+                    rpc_call: Callable[[int, Contact], tuple[list[Contact], Contact, str, RPCError]]) -> (
+            bool, Contact, str):
+        """
+        Queries the shortlist candidates closest first, with at most A_VAL RPCs in flight, until
+        the shortlist is finished. Outstanding RPCs are cancelled as soon as the value is found.
+
+        Returns
+            found, found_by, value
+        """
+        in_flight: set[asyncio.Task] = set()
+
+        def fill():
+            while len(in_flight) < A_VAL:
+                node = shortlist.next_candidate()
+                if node is None:
+                    return
+                in_flight.add(asyncio.create_task(self.get_closer_nodes(key, node, rpc_call, shortlist)))
+
+        try:
+            fill()
+            while in_flight and not shortlist.is_finished():
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                in_flight.difference_update(done)
+
+                for task in done:
+                    found, val, found_by = task.result()
+                    if found:
+                        return found, found_by, val
+
+                fill()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        return False, None, ""
 
     def set_error_handler(self, handler: Callable[[RPCError, Contact], None]):
         self.error_handler = handler
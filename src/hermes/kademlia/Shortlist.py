@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import heapq
+from enum import Enum
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    from hermes.kademlia.Contact import Contact
+
+from hermes.kademlia.Support import K_VAL
+
+class ContactState(Enum):
+    NEW = 0
+    PENDING = 1
+    RESPONDED = 2
+    FAILED = 3
+
+class Shortlist:
+    '''
+    Candidates of an iterative lookup ordered by XOR distance to the target key.
+    Candidates in the same distance band, the bucket they would fall in, are ordered by
+    how fast they are expected to answer.
+    Insertion is O(log n) through a heap, deduplication is O(1) through an id-indexed dict.
+    '''
+
+    def __init__(self, key: int, k: int = K_VAL, exclude: Iterable[int] = ()):
+        self._key = key
+        self._k = k
+        self._contacts: dict[int, 'Contact'] = {}
+        self._states: dict[int, ContactState] = {}
+        # (distance band, rto, distance, id) of every contact that was not queried yet
+        self._candidates: list[tuple[int, float, int, int]] = []
+        self._pending: set[int] = set()
+        # Max heap of (-distance, id) holding the k closest contacts that responded
+        self._closest: list[tuple[int, int]] = []
+        for id in exclude:
+            self._states[id] = ContactState.FAILED
+
+    def add(self, contact: 'Contact') -> bool:
+        """
+        Adds a contact as a candidate. Returns False if it was already known, or its circuit is open.
+        """
+        if contact.id in self._states:
+            return False
+        if contact.circuit_open:
+            self._states[contact.id] = ContactState.FAILED
+            return False
+        self._contacts[contact.id] = contact
+        self._states[contact.id] = ContactState.NEW
+        distance = contact.id ^ self._key
+        heapq.heappush(self._candidates, (distance.bit_length(), contact.rto, distance, contact.id))
+        return True
+
+    def extend(self, contacts: Iterable['Contact']):
+        for contact in contacts:
+            self.add(contact)
+
+    def next_candidate(self) -> Contact | None:
+        """
+        Returns the closest contact not queried yet and marks it pending. Returns None
+        if there is none left, or if it cannot get closer than the k closest that responded.
+        Contacts whose circuit opened since they were added are skipped.
+        """
+        while self._has_candidate():
+            *_, id = heapq.heappop(self._candidates)
+            if not self._contacts[id].try_request():
+                self._states[id] = ContactState.FAILED
+                continue
+            self._states[id] = ContactState.PENDING
+            self._pending.add(id)
+            return self._contacts[id]
+        return None
+
+    def mark_responded(self, contact: 'Contact'):
+        self._states[contact.id] = ContactState.RESPONDED
+        self._pending.discard(contact.id)
+
+        entry = (-(contact.id ^ self._key), contact.id)
+        if len(self._closest) < self._k:
+            heapq.heappush(self._closest, entry)
+        elif entry > self._closest[0]:
+            heapq.heapreplace(self._closest, entry)
+
+    def mark_failed(self, contact: 'Contact'):
+        self._states[contact.id] = ContactState.FAILED
+        self._pending.discard(contact.id)
+
+    def is_finished(self) -> bool:
+        """
+        The lookup ends once the k closest nodes that did not fail have all responded,
+        or when nobody is left to query.
+        """
+        if self._has_candidate():
+            return False
+        return not any(self._can_improve(id ^ self._key) for id in self._pending)
+
+    def _has_candidate(self) -> bool:
+        """
+        Drops the candidates that can no longer get closer than the k closest that responded, and
+        returns whether one that can is left. The head is then such a candidate.
+        """
+        while self._candidates:
+            band, _, distance, _ = self._candidates[0]
+            if not self._can_improve_band(band):
+                return False
+            if self._can_improve(distance):
+                return True
+            heapq.heappop(self._candidates)
+        return False
+
+    def _can_improve(self, distance: int) -> bool:
+        return len(self._closest) < self._k or distance < -self._closest[0][0]
+
+    def _can_improve_band(self, band: int) -> bool:
+        return len(self._closest) < self._k or band <= (-self._closest[0][0]).bit_length()
+
+    def closest(self) -> list[Contact]:
+        """
+        Returns the k closest contacts that responded, closest first.
+        """
+        return [self._contacts[id] for _, id in sorted(self._closest, reverse=True)]
+
+    def responded(self) -> list[Contact]:
+        """
+        Returns every contact that responded, closest first.
+        """
+        ids = [id for id, state in self._states.items() if state is ContactState.RESPONDED]
+        return [self._contacts[id] for id in sorted(ids, key=lambda id: id ^ self._key)]
+
+    def state(self, id: int) -> ContactState | None:
+        return self._states.get(id)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._contacts
+
+    def __len__(self) -> int:
+        return len(self._contacts)
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
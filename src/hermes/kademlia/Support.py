@@ -2,13 +2,107 @@ from dataclasses import dataclass
 
 # Size of KBuckets essentially
 K_VAL = 2
+# Replicas that must acknowledge a STORE before it returns, the others finish in the background
+WRITE_QUORUM = K_VAL // 2 + 1
 # System wide Concurrency Parameter
 A_VAL = K_VAL
 
 B_VAL = 3
 
+# Width of ids in bits
+ID_BITS = 160
+
+# Recently seen contacts kept per full bucket, to replace contacts that stop responding
+REPLACEMENT_CACHE_SIZE = K_VAL
+# Seconds after we last heard from a contact during which it is not pinged to check it is still around
+CONTACT_FRESHNESS = 60
+
 # 15 Seconds before timeout
 REQUEST_TIMEOUT = 10
 
+# Seconds before the first retransmission of an unanswered request, doubled on every retry
+RETRANSMIT_TIMEOUT = 0.5
+
+# Gains of the smoothed round trip time and of its variation, as in TCP (RFC 6298)
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+# Lower bound in seconds of the retransmission timeout derived from a peer's round trip time
+MIN_RTO = 0.05
+# Retransmissions a request to a peer with a measured round trip time gets before timing out
+RETRANSMIT_TRIES = 3
+
+# Consecutive failed requests after which lookups skip a peer, and seconds before it gets another chance
+CIRCUIT_FAILURES = 3
+CIRCUIT_RESET_TIMEOUT = 30
+# Consecutive failed requests after which a peer is evicted from its bucket
+EVICTION_FAILURES = 5
+# Number of failing peers whose failures are remembered while no bucket or lookup refers to them
+FAILING_CONTACTS = 1024
+
+# Milliseconds without a lookup after which a bucket is stale and gets refreshed
 BUCKET_REFRESH_INTERVAL = 1000000000000
+# Seconds between checks for stale buckets, varied by up to MAINTENANCE_JITTER of it so peers do not sync up
+MAINTENANCE_INTERVAL = 60
+MAINTENANCE_JITTER = 0.25
+# Stale buckets refreshed per check, the others wait for the next one
+REFRESH_BUDGET = 4
+
+# Bucket refreshes run at once while bootstrapping
+REFRESH_CONCURRENCY = A_VAL
+# Contacts in the routing table from which a bootstrapping node is ready to serve
+READY_CONTACTS = 2 * K_VAL
+
+# Tasks handling incoming requests, and requests waiting for them before new ones are shed
+SERVER_WORKERS = 16
+SERVER_QUEUE_SIZE = 256
+# Bytes of recent responses kept to answer duplicate requests, and seconds they are kept
+RESPONSE_CACHE_SIZE = 4 * 2 ** 20
+RESPONSE_CACHE_TTL = REQUEST_TIMEOUT
+
+# Requests per second and burst size accepted from a single host, for STOREs and for lookups
+STORE_RATE = (10, 20)
+LOOKUP_RATE = (100, 200)
+# Number of sources the rate limiter keeps track of
+RATE_LIMIT_SOURCES = 4096
+
+# Seconds between the routing table and storage snapshots sent to the processes of a server pool
+POOL_SYNC_INTERVAL = 1
+
+# Number of peer addresses whose wire capabilities are remembered
+PEER_CACHE_SIZE = 4096
+
+# Largest message sent in a single datagram, larger ones are split in fragments carrying this many bytes
+FRAGMENT_SIZE = 1200
+# Seconds without new fragments of a message before asking for the missing ones
+NACK_DELAY = 0.2
+# Share of a message that must have arrived before asking for the rest, and requests sent without progress.
+# A spoofed fragment then cannot make us send more than it carried.
+NACK_MIN_FRACTION = 1 / 4
+MAX_NACKS = 2
+# Seconds a message has to be reassembled before it is dropped
+FRAGMENT_TIMEOUT = REQUEST_TIMEOUT
+# Bytes held by incomplete messages, and by the fragments kept for retransmission
+REASSEMBLY_BUFFER_SIZE = 16 * 2 ** 20
+# Messages being reassembled at once
+REASSEMBLY_BUFFERS = 256
+SENT_CACHE_SIZE = 16 * 2 ** 20
+
+# Binary message bodies from this many bytes are compressed for peers that accept it
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+# Largest message body accepted once decompressed
+MAX_MESSAGE_SIZE = 64 * 2 ** 20
+
+# Requests carrying values of this many characters, and peers that returned one, use TCP
+TCP_PAYLOAD_THRESHOLD = 32 * 1024
+# Requests per second to a peer, averaged over TRAFFIC_WINDOW seconds, from which TCP is used
+TCP_TRAFFIC_THRESHOLD = 20
+TRAFFIC_WINDOW = 10
+# Connections kept per peer, and peers kept connected
+TCP_POOL_SIZE = 2
+TCP_MAX_PEERS = 64
+# Requests of a connection handled at once by the server
+TCP_PIPELINE_DEPTH = 32
+# Seconds before trying TCP again with a peer that refused it
+TCP_RETRY_INTERVAL = 60
 
@@ -125,7 +125,7 @@ async def start(vm: bool, listeners) -> (DHT, Hermes):
 
 
 async def bootstrap(dht, id, host, port):
-    prot = UDPProtocol(host, port)
+    prot = UDPProtocol(host, port, client=dht.client)
     await dht.bootstrap(Contact(prot, id, host, port))
     print("Bootstrapped successfully.")
 
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import random
+import struct
+
+from collections import OrderedDict
+from typing import Callable
+
+from hermes.kademlia.Support import FRAGMENT_SIZE, FRAGMENT_TIMEOUT, NACK_DELAY, REASSEMBLY_BUFFER_SIZE, \
+    SENT_CACHE_SIZE, REASSEMBLY_BUFFERS, NACK_MIN_FRACTION, MAX_NACKS
+
+logger = logging.getLogger(__name__)
+
+# Messages too large for a single datagram travel as numbered fragments, only between peers that
+# speak the binary wire format.
+#
+# Layout, big endian:
+#   fragment   magic (1) kind (1) message id (4) index (2) total (2) payload
+#   nack       magic (1) kind (1) message id (4) count (2) then count * missing index (2)
+#
+# A receiver that stops getting fragments of a message asks for the missing ones with a NACK,
+# and the sender resends only those from the fragments it keeps of the messages it sent.
+# Receivers only ask once enough of a message arrived, so when a message is sent again without
+# any NACK since it was last sent, the sender resends all of it.
+# All fragments but the last carry exactly the fragment size, anything else is dropped.
+
+# Never the first byte of a JSON document or of a binary wire message
+FRAGMENT_MAGIC = 0xC9
+
+MAX_FRAGMENTS = 0xFFFF
+
+# Bytes a reassembly buffer is charged on top of its payload, so empty ones count against the budget too
+BUFFER_OVERHEAD = 256
+
+_DATA = 0
+_NACK = 1
+
+_HEADER = struct.Struct("!BBIHH")
+_NACK_HEADER = struct.Struct("!BBIH")
+_INDEX = struct.Struct("!H")
+
+def is_fragment(data) -> bool:
+    return len(data) > 0 and data[0] == FRAGMENT_MAGIC
+
+def split(data: bytes, msg_id: int, size: int = FRAGMENT_SIZE) -> list[bytes]:
+    """
+    Splits a message into fragments carrying at most size bytes of it.
+
+    Raises:
+        ValueError: If the message needs more than MAX_FRAGMENTS fragments.
+    """
+    total = -(-len(data) // size)
+    if total > MAX_FRAGMENTS:
+        raise ValueError("Message too large to fragment.")
+    return [_HEADER.pack(FRAGMENT_MAGIC, _DATA, msg_id, i, total) + data[i * size:(i + 1) * size]
+            for i in range(total)]
+
+class _Buffer:
+    __slots__ = ('fragments', 'total', 'size', 'started', 'last', 'timer', 'nacks')
+
+    def __init__(self, total: int, now: float):
+        self.fragments: dict[int, bytes] = {}
+        self.total = total
+        self.size = 0
+        self.started = now
+        self.last = now
+        self.timer: asyncio.TimerHandle | None = None
+        # NACKs sent since the last new fragment
+        self.nacks = 0
+
+class _Sent:
+    __slots__ = ('fragments', 'nacked')
+
+    def __init__(self, fragments: list[bytes]):
+        self.fragments = fragments
+        # Whether the receiver sent a NACK since the message was last sent
+        self.nacked = False
+
+class Fragmenter:
+    '''
+    Fragments the oversized messages sent through an endpoint and reassembles the ones it receives.
+    Reassembly buffers are bounded in number and bytes, the fragments kept for retransmission in bytes,
+    and a message that is not complete within the timeout is dropped.
+    '''
+
+    def __init__(self, deliver: Callable[[bytes, tuple[str, int]], None],
+                 sendto: Callable[[bytes, tuple[str, int]], None], size: int = FRAGMENT_SIZE,
+                 timeout: float = FRAGMENT_TIMEOUT, max_bytes: int = REASSEMBLY_BUFFER_SIZE,
+                 cache_bytes: int = SENT_CACHE_SIZE, max_buffers: int = REASSEMBLY_BUFFERS):
+        """
+        Args:
+            deliver: Called with every reassembled message and the address it came from.
+            sendto: Sends a datagram.
+        """
+        self._deliver = deliver
+        self._sendto = sendto
+        self._size = size
+        self._timeout = timeout
+        self._max_bytes = max_bytes
+        self._cache_bytes = cache_bytes
+        self._max_buffers = max_buffers
+        # Messages being reassembled, oldest first
+        self._buffers: OrderedDict[tuple[tuple[str, int], int], _Buffer] = OrderedDict()
+        self._buffered = 0
+        # Fragments of the messages we sent, least recently used first
+        self._sent: OrderedDict[tuple[tuple[str, int], int], _Sent] = OrderedDict()
+        self._sent_bytes = 0
+
+    def send(self, data: bytes, addr: tuple[str, int], msg_id: int | None = None) -> int | None:
+        """
+        Sends a message, in fragments if it does not fit a datagram, and returns the id of a fragmented message.
+        Sending a message again under its id only sends its first fragment if the receiver asked for
+        missing fragments since, it then asks for whatever it still misses. Otherwise it resends all of them.
+        """
+        if len(data) <= self._size:
+            self._sendto(data, addr)
+            return None
+
+        key = (addr, msg_id)
+        if msg_id is not None and key in self._sent:
+            self._sent.move_to_end(key)
+            sent = self._sent[key]
+            for fragment in (sent.fragments[:1] if sent.nacked else sent.fragments):
+                self._sendto(fragment, addr)
+            sent.nacked = False
+            return msg_id
+
+        if msg_id is None:
+            msg_id = random.getrandbits(32)
+        fragments = split(data, msg_id, self._size)
+        self._cache((addr, msg_id), fragments)
+        for fragment in fragments:
+            self._sendto(fragment, addr)
+        return msg_id
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> bool:
+        """
+        Handles a fragment or NACK. Returns False if the datagram is neither.
+        """
+        if not is_fragment(data):
+            return False
+        try:
+            if data[1] == _DATA:
+                self._receive_fragment(data, addr)
+            elif data[1] == _NACK:
+                self._receive_nack(data, addr)
+        except (struct.error, IndexError, ValueError) as e:
+            logger.warning(f"Dropping malformed fragment from {addr[0]}:{addr[1]}: {str(e)}")
+        return True
+
+    def close(self):
+        for buffer in self._buffers.values():
+            if buffer.timer is not None:
+                buffer.timer.cancel()
+        self._buffers.clear()
+        self._buffered = 0
+        self._sent.clear()
+        self._sent_bytes = 0
+
+    def _cache(self, key: tuple[tuple[str, int], int], fragments: list[bytes]):
+        self._sent[key] = _Sent(fragments)
+        self._sent_bytes += sum(map(len, fragments))
+        while self._sent_bytes > self._cache_bytes and len(self._sent) > 1:
+            _, old = self._sent.popitem(last=False)
+            self._sent_bytes -= sum(map(len, old.fragments))
+
+    def _receive_fragment(self, data: bytes, addr: tuple[str, int]):
+        _, _, msg_id, index, total = _HEADER.unpack_from(data)
+        payload = bytes(data[_HEADER.size:])
+        # Only messages larger than a fragment are split, and all fragments but the last are full
+        if total < 2 or index >= total:
+            raise ValueError(f"Fragment {index} of {total}.")
+        if not payload or len(payload) > self._size or (index < total - 1 and len(payload) != self._size):
+            raise ValueError(f"Fragment {index} of {total} carrying {len(payload)} bytes.")
+
+        loop = asyncio.get_running_loop()
+        key = (addr, msg_id)
+        buffer = self._buffers.get(key)
+
+        if buffer is None:
+            buffer = _Buffer(total, loop.time())
+            self._buffers[key] = buffer
+            self._buffered += BUFFER_OVERHEAD
+            buffer.timer = loop.call_later(NACK_DELAY, self._check, key)
+        elif buffer.total != total:
+            raise ValueError(f"Fragment of {total} for a message of {buffer.total}.")
+
+        if index in buffer.fragments:
+            # Sent again, the sender is probing: tell it what is missing right away
+            self._nack(key, buffer)
+            return
+
+        buffer.fragments[index] = payload
+        buffer.size += len(payload)
+        buffer.last = loop.time()
+        buffer.nacks = 0
+        self._buffered += len(payload)
+
+        if len(buffer.fragments) == buffer.total:
+            self._discard(key)
+            self._deliver(b"".join(buffer.fragments[i] for i in range(buffer.total)), addr)
+            return
+
+        # Drop the oldest messages once over budget
+        while (self._buffered > self._max_bytes or len(self._buffers) > self._max_buffers) and self._buffers:
+            old_key = next(iter(self._buffers))
+            logger.warning(f"Reassembly buffers full, dropping message from {old_key[0][0]}:{old_key[0][1]}")
+            self._discard(old_key)
+
+    def _receive_nack(self, data: bytes, addr: tuple[str, int]):
+        _, _, msg_id, count = _NACK_HEADER.unpack_from(data)
+        sent = self._sent.get((addr, msg_id))
+        if sent is None:
+            logger.info(f"NACK from {addr[0]}:{addr[1]} for a message no longer kept")
+            return
+
+        sent.nacked = True
+        fragments = sent.fragments
+        for i in range(count):
+            (index,) = _INDEX.unpack_from(data, _NACK_HEADER.size + i * _INDEX.size)
+            if index < len(fragments):
+                self._sendto(fragments[index], addr)
+
+    def _check(self, key: tuple[tuple[str, int], int]):
+        """
+        Runs while a message is incomplete. Asks for the missing fragments once they stop coming in,
+        and drops the message when it times out.
+        """
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if now - buffer.started >= self._timeout:
+            logger.warning(f"Dropping incomplete message from {key[0][0]}:{key[0][1]}")
+            self._discard(key)
+            return
+
+        if now - buffer.last >= NACK_DELAY:
+            self._nack(key, buffer)
+            buffer.last = now
+        buffer.timer = loop.call_at(buffer.last + NACK_DELAY, self._check, key)
+
+    def _nack(self, key: tuple[tuple[str, int], int], buffer: _Buffer):
+        """
+        Asks for the missing fragments, once enough of the message arrived and at most MAX_NACKS times
+        without progress, so that what we send stays in proportion to what the sender sent.
+        """
+        if len(buffer.fragments) < buffer.total * NACK_MIN_FRACTION or buffer.nacks >= MAX_NACKS:
+            return
+        buffer.nacks += 1
+        addr, msg_id = key
+        # As many missing indexes as fit a datagram, the rest is asked for next time
+        missing = [i for i in range(buffer.total) if i not in buffer.fragments][:self._size // _INDEX.size]
+        data = _NACK_HEADER.pack(FRAGMENT_MAGIC, _NACK, msg_id, len(missing))
+        data += b"".join(_INDEX.pack(i) for i in missing)
+        self._sendto(data, addr)
+
+    def _discard(self, key: tuple[tuple[str, int], int]):
+        buffer = self._buffers.pop(key)
+        self._buffered -= buffer.size + BUFFER_OVERHEAD
+        if buffer.timer is not None:
+            buffer.timer.cancel()
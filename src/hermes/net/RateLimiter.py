@@ -0,0 +1,72 @@
+import time
+
+from collections import OrderedDict
+from typing import Callable
+
+from hermes.kademlia.Support import STORE_RATE, LOOKUP_RATE, RATE_LIMIT_SOURCES
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    '''
+    Token buckets per source host and request category. STOREs and lookups (FIND_NODE, FIND_VALUE, PING)
+    have separate budgets. Only the most recently active sources are tracked, so memory stays bounded.
+    '''
+
+    def __init__(self, store_rate: tuple[float, float] = STORE_RATE, lookup_rate: tuple[float, float] = LOOKUP_RATE,
+                 max_sources: int = RATE_LIMIT_SOURCES, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            store_rate: Requests per second and burst size allowed for STOREs.
+            lookup_rate: Requests per second and burst size allowed for every other request.
+            max_sources: Number of (source, category) buckets kept, the least recently used is dropped first.
+        """
+        self._rates = {"store": store_rate, "lookup": lookup_rate}
+        self._max_sources = max_sources
+        self._clock = clock
+        self._buckets: OrderedDict[tuple[str, str], TokenBucket] = OrderedDict()
+
+    @staticmethod
+    def category(type: str) -> str:
+        return "store" if type == "store" else "lookup"
+
+    def allow(self, host: str, type: str) -> bool:
+        """
+        Takes a token from the bucket of the source and request type. Returns False if it is empty.
+        """
+        category = self.category(type)
+        rate, burst = self._rates[category]
+        now = self._clock()
+        key = (host, category)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(burst, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self._max_sources:
+                # A forgotten source starts again with a full bucket
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    @property
+    def settings(self) -> tuple[tuple[float, float], tuple[float, float], int]:
+        """
+        The store rate, lookup rate and max sources, from which an equivalent limiter can be built.
+        """
+        return self._rates["store"], self._rates["lookup"], self._max_sources
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+
+from hermes.kademlia.Contact import Contact
+from hermes.kademlia.KBucket import KBucket
+from hermes.kademlia.Node import Node
+from hermes.kademlia.Storage import Storage
+from hermes.kademlia.Support import POOL_SYNC_INTERVAL, SERVER_WORKERS, SERVER_QUEUE_SIZE
+from hermes.net.RateLimiter import RateLimiter
+from hermes.net.UDPClient import UDPClient
+from hermes.net.UDPProtocol import UDPProtocol
+from hermes.net.UDPServer import UDPServer
+
+logger = logging.getLogger(__name__)
+
+# A snapshot of the routing table is a list of buckets as (low, high, [(id, host, port)])
+Buckets = list[tuple[int, int, list[tuple[int, str, int]]]]
+Snapshot = tuple[Buckets, dict[int, str]]
+# Changes since the previous snapshot: the buckets if they changed, the values set and the keys removed
+Update = tuple[Buckets | None, dict[int, str], list[int]]
+
+class ServerPool:
+    '''
+    Serves the port of a node from extra processes bound with SO_REUSEPORT, the kernel spreading the
+    incoming datagrams across them and the node's own server.
+    Workers answer FIND_NODE, FIND_VALUE and PING from a replica of the routing table and storage that is
+    refreshed every sync_interval seconds. STOREs and the senders they hear from are forwarded to this
+    process, which owns the node. Workers get only what changed since the previous sync.
+    '''
+
+    def __init__(self, node: Node, host: str, port: int, processes: int, client: UDPClient = None,
+                 sync_interval: float = POOL_SYNC_INTERVAL, workers: int = SERVER_WORKERS,
+                 queue_size: int = SERVER_QUEUE_SIZE, rate_limiter: RateLimiter = None, compression: bool = True):
+        """
+        Args:
+            workers, queue_size, rate_limiter, compression: Settings of the servers of the worker processes,
+                as for UDPServer. Every process gets its own limiter with the settings of rate_limiter.
+        """
+        self.node: Node = node
+        self.host: str = host
+        self.port: int = port
+        self.processes: int = processes
+        self.client: UDPClient = client
+        self.sync_interval: float = sync_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[multiprocessing.Process] = []
+        self._inboxes: list[multiprocessing.Queue] = []
+        self._outbox: multiprocessing.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        # Passed to the worker processes, which build their own servers
+        self._server_settings = (workers, queue_size, rate_limiter.settings if rate_limiter is not None else None,
+                                 compression)
+        # Last routing table and storage sent to the workers
+        self._sent_buckets: Buckets = []
+        self._sent_store: dict[int, str] = {}
+
+    async def start(self):
+        """
+        Starts the worker processes. The node's own server must already be bound to the port with reuse_port.
+        """
+        self._outbox = self._context.Queue()
+        snapshot = self.snapshot()
+        self._sent_buckets, self._sent_store = snapshot
+
+        for _ in range(self.processes):
+            inbox = self._context.Queue()
+            worker = self._context.Process(
+                target=_serve,
+                args=(self.node.our_contact.id, self.host, self.port, snapshot, inbox, self._outbox,
+                      self._server_settings),
+                daemon=True
+            )
+            worker.start()
+            self._inboxes.append(inbox)
+            self._workers.append(worker)
+
+        self._tasks = [asyncio.create_task(self._sync()), asyncio.create_task(self._drain())]
+        logger.info(f"Server pool of {self.processes} processes started on {self.host}:{self.port}")
+
+    async def stop(self):
+        sync, drain = self._tasks
+        sync.cancel()
+
+        for inbox in self._inboxes:
+            inbox.put(None)
+
+        loop = asyncio.get_running_loop()
+        for worker in self._workers:
+            await loop.run_in_executor(None, worker.join, self.sync_interval)
+            if worker.is_alive():
+                worker.terminate()
+
+        # Applies what the workers forwarded before stopping, then ends the drain
+        self._outbox.put(None)
+        await drain
+
+        self._tasks.clear()
+        self._workers.clear()
+        self._inboxes.clear()
+        logger.info(f"Server pool stopped on {self.host}:{self.port}")
+
+    def snapshot(self) -> Snapshot:
+        """
+        Returns a picklable copy of the routing table and storage of the node.
+        """
+        return self._buckets(), dict(self.node.storage.store)
+
+    def _buckets(self) -> Buckets:
+        return [(b.low, b.high, [(c.id, c.host, c.port) for c in b.contacts])
+                for b in self.node.bucket_list.buckets]
+
+    def update(self) -> Update | None:
+        """
+        Returns what changed in the routing table and storage since the last call, None if nothing did.
+        """
+        buckets = self._buckets()
+        store = self.node.storage.store
+        changed = {k: v for k, v in store.items() if self._sent_store.get(k) != v}
+        removed = [k for k in self._sent_store if k not in store]
+
+        if buckets == self._sent_buckets:
+            buckets = None
+        if buckets is None and not changed and not removed:
+            return None
+
+        if buckets is not None:
+            self._sent_buckets = buckets
+        self._sent_store.update(changed)
+        for k in removed:
+            del self._sent_store[k]
+        return buckets, changed, removed
+
+    async def _sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            update = self.update()
+            if update is None:
+                continue
+            for inbox in self._inboxes:
+                inbox.put(update)
+
+    async def _drain(self):
+        """
+        Applies the STOREs and contacts forwarded by the workers to the node.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # Bounded wait, so that cancelling the drain never leaves a thread blocked on the queue
+                message = await loop.run_in_executor(None, self._outbox.get, True, self.sync_interval)
+            except queue.Empty:
+                continue
+            if message is None:
+                return
+
+            try:
+                kind, (id, host, port), *args = message
+                if id == self.node.our_contact.id:
+                    continue
+                sender = self._contact(id, host, port)
+                if kind == "store":
+                    await self.node.store(sender, *args)
+                else:
+                    await self.node.bucket_list.add_contact(sender)
+            except Exception as e:
+                logger.error(f"Failed to apply forwarded {message[0]}: {str(e)}")
+
+    def _contact(self, id: int, host: str, port: int) -> Contact:
+        client = self.client if self.client is not None else UDPClient.default()
+        return client.contacts.intern(id, host, port, lambda h, p: UDPProtocol(h, p, client=self.client),
+                                      update_address=True)
+
+    @property
+    def alive(self) -> int:
+        return sum(worker.is_alive() for worker in self._workers)
+
+class ReplicaNode(Node):
+    '''
+    Read only copy of a node, serving lookups from the last snapshot and forwarding what would change it.
+    '''
+
+    def __init__(self, our_contact: Contact, outbox: multiprocessing.Queue):
+        super().__init__(our_contact, Storage())
+        self._outbox = outbox
+        # Senders already forwarded since the last snapshot
+        self._forwarded: set[int] = set()
+
+    def load(self, snapshot: Snapshot):
+        buckets, store = snapshot
+        self._load_buckets(buckets)
+        self._storage.store = store
+
+    def apply(self, update: Update):
+        buckets, changed, removed = update
+        if buckets is not None:
+            self._load_buckets(buckets)
+        self._storage.store.update(changed)
+        for key in removed:
+            self._storage.store.pop(key, None)
+
+    def _load_buckets(self, buckets: Buckets):
+        kbuckets = []
+        for low, high, contacts in buckets:
+            kbucket = KBucket(low, high)
+            kbucket.contacts = [Contact(None, id, host, port) for id, host, port in contacts]
+            kbuckets.append(kbucket)
+        self._bucket_list.buckets = kbuckets
+        self._forwarded.clear()
+
+    def _seen(self, sender: Contact):
+        if sender.id not in self._forwarded and not self._bucket_list.get_kbucket(sender.id).contains(sender.id):
+            self._forwarded.add(sender.id)
+            self._outbox.put(("contact", (sender.id, sender.host, sender.port)))
+
+    def ping(self, sender):
+        self._seen(sender)
+        return self._our_contact
+
+    async def store(self, sender: Contact, key: int, val: str, expiration: int = 0):
+        assert sender.id != self._our_contact.id, "Sender cannot be us!"
+        # Kept here too so the value can be found before the next snapshot
+        self._storage.set(key, val, expiration)
+        self._outbox.put(("store", (sender.id, sender.host, sender.port), key, val, expiration))
+
+    async def find_node(self, sender, key) -> (list[Contact], int):
+        assert sender.id != self._our_contact.id, "Sender cannot be us!"
+        self._seen(sender)
+        return await self._bucket_list.get_close_contacts(key, sender.id), None
+
+    async def find_value(self, sender, key) -> (list[Contact], str):
+        assert sender.id != self._our_contact.id, "Sender cannot be us!"
+        self._seen(sender)
+        if self._storage.contains(key):
+            return None, self._storage.get(key)
+        return await self._bucket_list.get_close_contacts(key, sender.id), None
+
+def _serve(id: int, host: str, port: int, snapshot: Snapshot, inbox: multiprocessing.Queue,
+           outbox: multiprocessing.Queue, settings: tuple):
+    """
+    Entry point of a worker process.
+    """
+    asyncio.run(_run_worker(id, host, port, snapshot, inbox, outbox, settings))
+
+async def _run_worker(id: int, host: str, port: int, snapshot: Snapshot, inbox: multiprocessing.Queue,
+                      outbox: multiprocessing.Queue, settings: tuple):
+    node = ReplicaNode(Contact(None, id, host, port), outbox)
+    node.load(snapshot)
+
+    # Datagrams of a source always reach the same process, so per process limits hold
+    workers, queue_size, rates, compression = settings
+    server = UDPServer(node, host, port, workers=workers, queue_size=queue_size,
+                       rate_limiter=RateLimiter(*rates) if rates is not None else None, compression=compression)
+    await server.start(lambda addr: None, reuse_port=True)
+
+    loop = asyncio.get_running_loop()
+    try:
+        while (update := await loop.run_in_executor(None, inbox.get)) is not None:
+            node.apply(update)
+    finally:
+        await server.stop()
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import struct
+import time
+
+from collections import OrderedDict
+
+from hermes.kademlia.Support import REQUEST_TIMEOUT, TCP_POOL_SIZE, TCP_MAX_PEERS, TCP_RETRY_INTERVAL, \
+    MAX_MESSAGE_SIZE
+from hermes.net.Wire import encode, decode
+
+logger = logging.getLogger(__name__)
+
+# Every message on a stream is preceded by its length
+FRAME = struct.Struct("!I")
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    """
+    Reads a length prefixed message.
+
+    Raises:
+        asyncio.IncompleteReadError: If the stream ends.
+        ConnectionError: If the announced length is too large.
+    """
+    (size,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if size > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f"Frame of {size} bytes is too large.")
+    return await reader.readexactly(size)
+
+def frame(data: bytes) -> bytes:
+    return FRAME.pack(len(data)) + data
+
+class TCPConnection:
+    '''
+    Persistent stream to a peer. Requests are pipelined: any number can be outstanding,
+    responses are matched to them through the echoed random_id.
+    '''
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._pending: dict[int, asyncio.Future] = {}
+        self._reading = asyncio.create_task(self._read())
+
+    async def _read(self):
+        error = ConnectionError("TCP connection closed.")
+        try:
+            while True:
+                response = decode(await read_frame(self._reader))
+                future = self._pending.get(response["data"]["random_id"])
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except Exception as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                error = ConnectionError(str(e))
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.close()
+
+    async def request(self, request_data: dict, timeout: float) -> dict:
+        """
+        Raises:
+            asyncio.TimeoutError: If no response arrives within the timeout.
+            ConnectionError: If the connection is lost.
+        """
+        if self.closed:
+            raise ConnectionError("TCP connection closed.")
+
+        random_id = request_data["data"]["random_id"]
+        future = asyncio.get_running_loop().create_future()
+        self._pending[random_id] = future
+        try:
+            # Only peers that run a TCP server get here, and they decode binary compressed messages
+            self._writer.write(frame(encode(request_data, True, True)))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(random_id, None)
+
+    def close(self):
+        self._writer.close()
+        if not self._reading.done() and self._reading is not asyncio.current_task():
+            self._reading.cancel()
+
+    @property
+    def closed(self) -> bool:
+        return self._writer.is_closing()
+
+    @property
+    def load(self) -> int:
+        return len(self._pending)
+
+class TCPClient:
+    '''
+    Pools up to pool_size connections per peer, for the most recently used TCP_MAX_PEERS peers.
+    Peers that refuse connections are not tried again before TCP_RETRY_INTERVAL.
+    '''
+
+    def __init__(self, pool_size: int = TCP_POOL_SIZE, max_peers: int = TCP_MAX_PEERS):
+        self._pool_size = pool_size
+        self._max_peers = max_peers
+        self._pools: OrderedDict[tuple[str, int], list[TCPConnection]] = OrderedDict()
+        self._locks: dict[tuple[str, int], asyncio.Lock] = {}
+        # Monotonic time at which peers without a TCP server refused a connection
+        self._refused: OrderedDict[tuple[str, int], float] = OrderedDict()
+
+    def accepts(self, addr: tuple[str, int]) -> bool:
+        """
+        Whether the peer is worth trying over TCP.
+        """
+        refused = self._refused.get(addr)
+        if refused is None:
+            return True
+        if time.monotonic() - refused >= TCP_RETRY_INTERVAL:
+            del self._refused[addr]
+            return True
+        return False
+
+    async def request(self, request_data: dict, addr: tuple[str, int], timeout: float = REQUEST_TIMEOUT) -> dict:
+        """
+        Sends a request over a pooled connection to the peer and waits for its response.
+
+        Raises:
+            asyncio.TimeoutError: If no response arrives within the timeout.
+            ConnectionError: If the peer cannot be reached over TCP.
+        """
+        connection = await self._connection(addr, timeout)
+        return await connection.request(request_data, timeout)
+
+    async def _connection(self, addr: tuple[str, int], timeout: float) -> TCPConnection:
+        lock = self._locks.setdefault(addr, asyncio.Lock())
+        async with lock:
+            pool = [c for c in self._pools.get(addr, []) if not c.closed]
+            self._pools[addr] = pool
+            self._pools.move_to_end(addr)
+
+            idle = min(pool, key=lambda c: c.load, default=None)
+            if idle is not None and (idle.load == 0 or len(pool) >= self._pool_size):
+                return idle
+
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*addr), timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                self._refused[addr] = time.monotonic()
+                if len(self._refused) > self._max_peers:
+                    self._refused.popitem(last=False)
+                if not pool:
+                    del self._pools[addr]
+                    self._locks.pop(addr, None)
+                raise ConnectionError(f"TCP connection to {addr[0]}:{addr[1]} failed: {str(e)}") from e
+
+            connection = TCPConnection(reader, writer)
+            pool.append(connection)
+            self._trim()
+            return connection
+
+    def _trim(self):
+        """
+        Closes the connections of the least recently used peers beyond max_peers.
+        """
+        while len(self._pools) > self._max_peers:
+            addr, pool = self._pools.popitem(last=False)
+            self._locks.pop(addr, None)
+            for connection in pool:
+                connection.close()
+
+    def close(self):
+        for pool in self._pools.values():
+            for connection in pool:
+                connection.close()
+        self._pools.clear()
+        self._locks.clear()
+
+    @property
+    def connections(self) -> int:
+        return sum(len(pool) for pool in self._pools.values())
@@ -0,0 +1,22 @@
+import logging
+
+from hermes.net.RPCProtocol import RPCProtocol
+from hermes.net.UDPProtocol import UDPProtocol
+from hermes.kademlia.Support import REQUEST_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+class TCPProtocol(RPCProtocol):
+    '''
+    Class that implements the networking side of the kademlia protocol over pooled, pipelined TCP connections
+    '''
+    __slots__ = ()
+
+    async def _request(self, request_data: dict) -> dict:
+        peer = self.peer
+        return await self.client.tcp.request(request_data, (self._host, self._port),
+                                             peer.timeout if peer else REQUEST_TIMEOUT)
+
+    def _peer_protocol(self, host: str, port: int) -> UDPProtocol:
+        # Peers we hear of may not run a TCP server, UDPProtocol switches to TCP when it is worth it
+        return UDPProtocol(host, port, client=self._client)
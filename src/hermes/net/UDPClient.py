@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import weakref
+
+from collections import OrderedDict
+from typing import Callable
+
+from hermes.kademlia.ContactRegistry import ContactRegistry
+from hermes.kademlia.Support import REQUEST_TIMEOUT, RETRANSMIT_TIMEOUT, PEER_CACHE_SIZE
+from hermes.net.Wire import encode, decode, is_binary, accepts_compression, WIRE_VERSION
+from hermes.net.Fragment import Fragmenter
+from hermes.net.TCPClient import TCPClient
+
+logger = logging.getLogger(__name__)
+
+class UDPClient(asyncio.DatagramProtocol):
+    '''
+    Long-lived datagram endpoint shared by all outgoing RPCs of a node.
+    Responses are matched to their pending request through the echoed random_id.
+    '''
+
+    # Fallback clients for protocols created without one, one per event loop
+    _defaults: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __init__(self, local_addr: tuple[str, int] = ("0.0.0.0", 0), compression: bool = True):
+        self._local_addr = local_addr
+        # Compress large requests to the peers that accept it
+        self.compression = compression
+        self._pending: dict[int, asyncio.Future] = {}
+        self._lock = asyncio.Lock()
+        self.transport = None
+        # Every peer this node hears of, shared by the protocols using this endpoint
+        self.contacts: ContactRegistry = ContactRegistry()
+        # Addresses known to decode the binary wire format, least recently used first,
+        # and whether they also decode compressed messages
+        self._binary_peers: OrderedDict[tuple[str, int], bool] = OrderedDict()
+        # Fragments messages too large for a datagram, to and from binary capable peers
+        self._fragments = Fragmenter(self._receive, self._sendto)
+        # Pooled connections for bulk transfers and busy peers
+        self.tcp: TCPClient = TCPClient()
+
+    @classmethod
+    def default(cls) -> 'UDPClient':
+        """
+        Returns the client shared by every protocol of the running event loop
+        that was not given its own client.
+        """
+        loop = asyncio.get_running_loop()
+        client = cls._defaults.get(loop)
+        if client is None:
+            client = cls()
+            cls._defaults[loop] = client
+        return client
+
+    async def start(self):
+        """
+        Binds the endpoint if it is not open yet.
+        """
+        async with self._lock:
+            if self.transport is None or self.transport.is_closing():
+                loop = asyncio.get_running_loop()
+                await loop.create_datagram_endpoint(lambda: self, local_addr=self._local_addr)
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+        self.tcp.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._fragments.close()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("UDP client endpoint closed."))
+        self._pending.clear()
+
+    def datagram_received(self, data, addr):
+        if not self._fragments.datagram_received(data, addr):
+            self._receive(data, addr)
+
+    def _sendto(self, data: bytes, addr: tuple[str, int]):
+        if self.transport is not None:
+            self.transport.sendto(data, addr)
+
+    def _receive(self, data: bytes, addr: tuple[str, int]):
+        try:
+            response = decode(data)
+            random_id = response["data"]["random_id"]
+        except Exception as e:
+            logger.warning(f"Dropping malformed datagram from {addr[0]}:{addr[1]}: {str(e)}")
+            return
+
+        if is_binary(data):
+            self.mark_binary(addr, accepts_compression(data))
+        elif response.get("wire", 0) >= WIRE_VERSION and not self.speaks_binary(addr):
+            self.mark_binary(addr)
+
+        future = self._pending.get(random_id)
+        if future is None or future.done():
+            # Late answer to a request that already timed out
+            logger.info(f"Dropping unexpected response from {addr[0]}:{addr[1]}")
+            return
+        future.set_result(response)
+
+    async def request(self, request_data: dict, addr: tuple[str, int], timeout: float = REQUEST_TIMEOUT,
+                      retransmit: float = RETRANSMIT_TIMEOUT, on_rtt: Callable[[float], None] = None) -> dict:
+        """
+        Sends a request and waits for the response carrying the same random_id.
+        The request is sent again with the same random_id whenever no response arrived in time,
+        starting after retransmit seconds and doubling the wait on every try, until the overall timeout.
+        on_rtt is given the round trip time of requests answered without retransmission, since an answer
+        to a retransmitted request cannot be matched to the copy it answers.
+
+        Raises:
+            asyncio.TimeoutError: If no response arrives within the timeout.
+        """
+        await self.start()
+
+        loop = asyncio.get_running_loop()
+        random_id = request_data["data"]["random_id"]
+        future = loop.create_future()
+        self._pending[random_id] = future
+
+        binary = self.speaks_binary(addr)
+        data = encode(request_data, binary, self.compression and self.accepts_compression(addr))
+        # Id of the request once fragmented, so that retransmissions only probe for missing fragments
+        msg_id = None
+        sent_at = loop.time()
+        deadline = sent_at + timeout
+        wait = retransmit
+        retransmitted = False
+
+        try:
+            while True:
+                if self.transport is None:
+                    raise ConnectionError("UDP client endpoint closed.")
+                if binary:
+                    msg_id = self._fragments.send(data, addr, msg_id)
+                else:
+                    self.transport.sendto(data, addr)
+
+                try:
+                    # Shielded so that giving up on this try leaves the request pending
+                    response = await asyncio.wait_for(asyncio.shield(future), min(wait, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        raise
+                    wait *= 2
+                    retransmitted = True
+                    logger.info(f"Retransmitting request to {addr[0]}:{addr[1]}")
+                    continue
+
+                if on_rtt is not None and not retransmitted:
+                    on_rtt(loop.time() - sent_at)
+                return response
+        finally:
+            self._pending.pop(random_id, None)
+
+    def mark_binary(self, addr: tuple[str, int], compression: bool = False):
+        """
+        Remembers that the peer at addr decodes the binary wire format, and if it decodes compressed messages.
+        """
+        self._binary_peers[addr] = compression
+        self._binary_peers.move_to_end(addr)
+        if len(self._binary_peers) > PEER_CACHE_SIZE:
+            self._binary_peers.popitem(last=False)
+
+    def speaks_binary(self, addr: tuple[str, int]) -> bool:
+        return addr in self._binary_peers
+
+    def accepts_compression(self, addr: tuple[str, int]) -> bool:
+        return self._binary_peers.get(addr, False)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
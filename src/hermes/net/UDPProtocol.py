@@ -1,256 +1,67 @@
-import asyncio
-import json
+import math
+import time
+import logging
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from hermes.kademlia.Node import Node
 
-import random
-import logging
-
-from hermes.kademlia.Protocol import Protocol
-from hermes.kademlia.RPCError import RPCError
-from hermes.kademlia.Contact import Contact
-from hermes.net.Payload import *
-from hermes.kademlia.Support import REQUEST_TIMEOUT, BUCKET_REFRESH_INTERVAL
+from hermes.kademlia.Support import REQUEST_TIMEOUT, TCP_PAYLOAD_THRESHOLD, TCP_TRAFFIC_THRESHOLD, TRAFFIC_WINDOW
+from hermes.net.RPCProtocol import RPCProtocol
+from hermes.net.UDPClient import UDPClient
 
 logger = logging.getLogger(__name__)
 
-class UDPProtocol(Protocol):
+class UDPProtocol(RPCProtocol):
     '''
-    Class that implements the networking side of the kademlia protocol using UDP
+    Class that implements the networking side of the kademlia protocol using UDP.
+    Large payloads, and all requests to peers with heavy traffic, go over TCP when the peer accepts it.
     '''
-
-    def __init__(self, host: str, port: int, node: 'Node' = None):
-        super().__init__(node=node)
-        self._host = host
-        self._port = port
-
-    async def find_node(self, sender: Contact, key: int) -> (list[Contact], RPCError):
-        random_id = random.randint(0, 2**160-1)
-
-        request = FindNodeRequest(
-            protocol_name=self.__class__.__name__,
-            random_id=random_id,
-            sender=sender.id,
-            sender_host=sender.host,
-            sender_port=sender.port,
-            key=key
-        )
-
-        request_data = {"type": "find_node", "data": asdict(request)}
-        loop = asyncio.get_running_loop()
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: UDPClientHandler(),
-            local_addr=("0.0.0.0", 0)
-        )
-
-        try:
-            # Send datagram
-            logger.info(f"Sending FIND_NODE RPC to: {self._host}:{self._port}")
-            transport.sendto(json.dumps(request_data).encode(), (self._host, self._port))
-            data, _ = await asyncio.wait_for(protocol.receive(), REQUEST_TIMEOUT)
-            response = json.loads(data)
-
-            # Check for error from remote node
-            if response["type"] == "error":
-                error = ErrorResponse(**response["data"])
-                logger.error(f"FIND_NODE Error response from: {self._host}:{self._port} sent error: {error.error_message}")
-                return [], RPCError(peer_error=True, peer_error_message=error.error_message)
-            # Check if echoed id matches
-            if response["data"]["random_id"] != random_id:
-                logger.error(f"FIND_NODE Error: id_mismatch_error")
-                return [], RPCError(id_mismatched_error=True)
-
-            # Get the response, and repackage
-            response = FindNodeResponse(**response["data"])
-
-            if response.contacts is not None:
-                contacts = [
-                    Contact(
-                        UDPProtocol(host=c['host'], port=c['port']),
-                        c['contact'],
-                        host=c['host'],
-                        port=c['port']
-                    )
-                    for c in response.contacts
-                ]
-                logger.info(f"FIND_NODE returned {len(contacts)} contacts from {self._host}:{self._port}")
-                return contacts, RPCError()
-            else:
-                logger.info(f"FIND_NODE returned NOTHING from {self._host}:{self._port}")
-                return [], RPCError()
-
-        except asyncio.TimeoutError:
-            logger.error(f"FIND_NODE timed out on {self._host}:{self._port}")
-            return [], RPCError(timeout_error=True)
-        except Exception as e:
-            logger.error(f"FIND_NODE Error: {str(e)}")
-            return [], RPCError(protocol_error=True, peer_error_message=str(e))
-        finally:
-            transport.close()
-
-    async def find_value(self, sender: Contact, key: int) -> (list[Contact], str, RPCError):
-        random_id = random.randint(0, 2 ** 160 - 1)
-
-        request = FindValueRequest(
-            protocol_name=self.__class__.__name__,
-            random_id=random_id,
-            sender=sender.id,
-            sender_host=sender.host,
-            sender_port=sender.port,
-            key=key
-        )
-
-        request_data = {"type": "find_value", "data": asdict(request)}
-        loop = asyncio.get_running_loop()
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: UDPClientHandler(),
-            local_addr=("0.0.0.0", 0)
-        )
-
-        try:
-            logger.info(f"Sending FIND_VALUE RPC to: {self._host}:{self._port}")
-            transport.sendto(json.dumps(request_data).encode(), (self._host, self._port))
-            data, _ = await asyncio.wait_for(protocol.receive(), REQUEST_TIMEOUT)
-            response = json.loads(data.decode())
-
-            if response["type"] == "error":
-                error = ErrorResponse(**response["data"])
-                logger.error(f"FIND_VALUE Error response from: {self._host}:{self._port} sent error: {error.error_message}")
-                return [], None, RPCError(peer_error=True, peer_error_message=error.error_message)
-            if response["data"]["random_id"] != random_id:
-                logger.error("FIND_VALUE Error: id_mismatch_error")
-                return [], None, RPCError(id_mismatched_error=True)
-            response = FindValueResponse(**response["data"])
-
-            if response.value is not None:
-                logger.info(f"FIND_VALUE returned value from {self._host}:{self._port}")
-                return [], response.value, RPCError()
-            else:
-                if response.contacts is not None:
-                    logger.info(f"FIND_VALUE returned {len(response.contacts)} contacts from {self._host}:{self._port}")
-                    contacts = [
-                        Contact(
-                            UDPProtocol(host=c['host'], port=c['port']),
-                            c['contact'],
-                            host=c['host'],
-                            port=c['port']
-                        ) for c in response.contacts
-                    ]
-                    return contacts, None, RPCError()
-                else:
-                    logger.info(f"FIND_VALUE returned NOTHING from {self._host}:{self._port}")
-                    return [], None, RPCError()
-        except asyncio.TimeoutError:
-            logger.error(f"FIND_VALUE timed out on {self._host}:{self._port}")
-            return [], None, RPCError(timeout_error=True)
-        except Exception as e:
-            logger.error(f"FIND_VALUE Error: {str(e)}")
-            return [], None, RPCError(protocol_error=True, peer_error_message=str(e))
-        finally:
-            transport.close()
-
-    async def ping(self, sender: Contact) -> RPCError:
-        random_id = random.randint(0, 2 ** 160 - 1)
-
-        request = PingRequest(
-            protocol_name=self.__class__.__name__,
-            random_id=random_id,
-            sender=sender.id,
-            sender_host=sender.host,
-            sender_port=sender.port,
-        )
-
-        request_data = {"type": "ping", "data": asdict(request)}
-        loop = asyncio.get_running_loop()
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: UDPClientHandler(),
-            local_addr=("0.0.0.0", 0)
-        )
-
-        try:
-            logger.info(f"Sending PING RPC to: {self._host}:{self._port}")
-            transport.sendto(json.dumps(request_data).encode(), (self._host, self._port))
-            data, _ = await asyncio.wait_for(protocol.receive(), REQUEST_TIMEOUT)
-            response = json.loads(data.decode())
-
-            if response["type"] == "error":
-                error = ErrorResponse(**response["data"])
-                logger.error(f"PING Error response from: {self._host}:{self._port} sent error: {error.error_message}")
-                return RPCError(peer_error=True, peer_error_message=error.error_message)
-            if response["data"]["random_id"] != random_id:
-                logger.error("PING Error: id_mismatch_error")
-                return RPCError(id_mismatched_error=True)
-            logger.info(f"PING successful to {self._host}:{self._port}")
-            return RPCError()
-        except asyncio.TimeoutError:
-            logger.error(f"PING timed out on {self._host}:{self._port}")
-            return RPCError(timeout_error=True)
-        except Exception as e:
-            logger.error(f"PING Error: {str(e)}")
-            return RPCError(protocol_error=True, peer_error_message=str(e))
-        finally:
-            transport.close()
-
-    async def store(self, sender: Contact, key: int, val: str, exp_time: int = BUCKET_REFRESH_INTERVAL) -> RPCError:
-        random_id = random.randint(0, 2 ** 160 - 1)
-
-        request = StoreRequest(
-            protocol_name=self.__class__.__name__,
-            random_id=random_id,
-            sender=sender.id,
-            sender_host=sender.host,
-            sender_port=sender.port,
-            key=key,
-            value=val,
-            exp_time=exp_time
-        )
-
-        request_data = {"type": "store", "data": asdict(request)}
-        loop = asyncio.get_running_loop()
-        transport, protocol = await loop.create_datagram_endpoint(
-            lambda: UDPClientHandler(),
-            local_addr=("0.0.0.0", 0)
-        )
-
-        try:
-            logger.info(f"Sending STORE RPC to: {self._host}:{self._port}")
-            transport.sendto(json.dumps(request_data).encode(), (self._host, self._port))
-            data, _ = await asyncio.wait_for(protocol.receive(), REQUEST_TIMEOUT)
-            response = json.loads(data.decode())
-
-            if response["type"] == "error":
-                error = ErrorResponse(**response["data"])
-                logger.error(f"STORE Error response from: {self._host}:{self._port} sent error: {error.error_message}")
-                return RPCError(peer_error=True, peer_error_message=error.error_message)
-            if response["data"]["random_id"] != random_id:
-                logger.error("STORE Error: id_mismatch_error")
-                return RPCError(id_mismatched_error=True)
-
-            logger.info(f"STORE successful to {self._host}:{self._port}")
-            return RPCError()
-
-        except asyncio.TimeoutError:
-            logger.error(f"STORE timed out on {self._host}:{self._port}")
-            return RPCError(timeout_error=True)
-        except Exception as e:
-            logger.error(f"STORE Error: {str(e)}")
-            return RPCError(protocol_error=True, peer_error_message=str(e))
-        finally:
-            transport.close()
-
-class UDPClientHandler(asyncio.DatagramProtocol):
-    def __init__(self):
-        self.future = asyncio.Future()
-
-    def connection_made(self, transport):
-        self.transport = transport
-
-    def datagram_received(self, data, addr):
-        if not self.future.done():
-            self.future.set_result((data, addr))
-
-    async def receive(self):
-        return await self.future
-
+    __slots__ = ('_traffic', '_traffic_at', '_bulk')
+
+    def __init__(self, host: str, port: int, node: 'Node' = None, client: UDPClient = None):
+        super().__init__(host, port, node=node, client=client)
+        # Requests per second sent to the peer, decaying over TRAFFIC_WINDOW
+        self._traffic = 0.0
+        self._traffic_at = time.monotonic()
+        # Whether the peer returned a value too large for datagrams
+        self._bulk = False
+
+    async def _request(self, request_data: dict) -> dict:
+        """
+        Sends the request with timeouts fitted to the peer's round trip time,
+        and feeds the measured round trip time back into its estimate.
+        """
+        addr = (self._host, self._port)
+        peer = self.peer
+
+        if self._use_tcp(request_data):
+            try:
+                return await self.client.tcp.request(request_data, addr, peer.timeout if peer else REQUEST_TIMEOUT)
+            except ConnectionError as e:
+                logger.info(f"Falling back to UDP for {self._host}:{self._port}: {str(e)}")
+
+        if peer is None:
+            response = await self.client.request(request_data, addr)
+        else:
+            response = await self.client.request(request_data, addr, timeout=peer.timeout, retransmit=peer.rto,
+                                                 on_rtt=peer.update_rtt)
+
+        value = response["data"].get("value")
+        if isinstance(value, str) and len(value) >= TCP_PAYLOAD_THRESHOLD:
+            self._bulk = True
+        return response
+
+    def _use_tcp(self, request_data: dict) -> bool:
+        now = time.monotonic()
+        self._traffic = self._traffic * math.exp((self._traffic_at - now) / TRAFFIC_WINDOW) + 1 / TRAFFIC_WINDOW
+        self._traffic_at = now
+
+        if not self.client.tcp.accepts((self._host, self._port)):
+            return False
+        value = request_data["data"].get("value")
+        return (self._bulk or self._traffic >= TCP_TRAFFIC_THRESHOLD
+                or (isinstance(value, str) and len(value) >= TCP_PAYLOAD_THRESHOLD))
+
+    def _peer_protocol(self, host: str, port: int) -> 'UDPProtocol':
+        return UDPProtocol(host, port, client=self._client)
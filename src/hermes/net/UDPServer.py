@@ -1,30 +1,50 @@
-from typing import TYPE_CHECKING
-
-from black.lines import Callable
+from typing import TYPE_CHECKING, Callable
 
 if TYPE_CHECKING:
     from hermes.kademlia.Node import Node
 
 
 import json
+import time
 import socket
 import logging
 import asyncio
+from collections import OrderedDict
 from dataclasses import asdict
 
 from hermes.net.Payload import CommonRequest, PingResponse, FindNodeResponse, ContactResponse, StoreResponse, \
     FindValueResponse, ErrorResponse
 from hermes.net.UDPProtocol import UDPProtocol
+from hermes.net.UDPClient import UDPClient
+from hermes.net.RateLimiter import RateLimiter
+from hermes.net.Fragment import Fragmenter
+from hermes.net.TCPClient import read_frame, frame
+from hermes.net.Wire import encode, decode, is_binary, accepts_compression, peek_random_id, peek_type
+from hermes.kademlia.Support import SERVER_WORKERS, SERVER_QUEUE_SIZE, TCP_PIPELINE_DEPTH, RESPONSE_CACHE_SIZE, \
+    RESPONSE_CACHE_TTL
 from hermes.kademlia.Contact import Contact
 
 logger = logging.getLogger(__name__)
 
 class UDPServer:
-    def __init__(self, node: 'Node', host: str, port: int):
+    def __init__(self, node: 'Node', host: str, port: int, client: UDPClient = None,
+                 workers: int = SERVER_WORKERS, queue_size: int = SERVER_QUEUE_SIZE,
+                 rate_limiter: RateLimiter = None, compression: bool = True):
         self.node: 'Node' = node
         self.host: str = host
         self.port: int = port
+        # Endpoint used by the protocols of the contacts we learn about
+        self.client: UDPClient = client
+        self.workers: int = workers
+        self.queue_size: int = queue_size
+        # Requests beyond a source's budget are refused, no limit if None
+        self.rate_limiter: RateLimiter | None = rate_limiter
+        # Compress large responses to the peers that accept it
+        self.compression: bool = compression
         self.transport = None
+        self.protocol: UDPServerProtocol | None = None
+        # Serves the same requests over TCP, on the same port
+        self.tcp_server: asyncio.Server | None = None
         self.handlers = {
             "find_node": self.handle_find_node,
             "find_value": self.handle_find_value,
@@ -45,31 +65,90 @@ class UDPServer:
             s.close()
         return ip
 
-    async def start(self, update_addr: Callable):
+    async def start(self, update_addr: Callable, reuse_port: bool = False):
+        """
+        Binds the server. With reuse_port, other processes can bind the same port and share its traffic.
+        """
         loop = asyncio.get_running_loop()
         host = self.check_bound_ip(self.host)
-        self.transport, protocol = await loop.create_datagram_endpoint(
-            lambda: UDPServerProtocol(self.node, self.handlers),
-            local_addr=(host, self.port)
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            lambda: UDPServerProtocol(self.node, self.handlers, self.workers, self.queue_size,
+                                      self.rate_limiter, self.compression),
+            local_addr=(host, self.port),
+            reuse_port=reuse_port
         )
         addr =  self.transport.get_extra_info("sockname")
+
+        try:
+            self.tcp_server = await asyncio.start_server(self._serve_stream, addr[0], addr[1], reuse_port=reuse_port)
+        except OSError as e:
+            logger.warning(f"TCP Server not started on {addr[0]}:{addr[1]}: {str(e)}")
+
         update_addr((addr[0], addr[1]))
         logger.info(f"UDP Server started on {addr[0]}:{addr[1]}")
 
     async def stop(self):
         if self.transport:
             self.transport.close()
+        if self.tcp_server:
+            self.tcp_server.close()
+            self.tcp_server.close_clients()
+            self.tcp_server = None
         logger.info(f"UDP Server stopped on {self.host}:{self.port}")
 
+    async def _serve_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles the length prefixed requests of a TCP connection, up to TCP_PIPELINE_DEPTH at once.
+        Requests go through the same rate limits, queue and workers as datagrams.
+        Responses are written as they are ready, in any order.
+        """
+        addr = writer.get_extra_info("peername")[:2]
+        depth = asyncio.Semaphore(TCP_PIPELINE_DEPTH)
+
+        def reply(message: dict | bytes | None):
+            depth.release()
+            if message is not None and not writer.is_closing():
+                if not isinstance(message, bytes):
+                    message = encode(message, True, self.compression)
+                writer.write(frame(message))
+
+        try:
+            while True:
+                data = await read_frame(reader)
+                await depth.acquire()
+                self.protocol.submit(data, addr, reply)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.info(f"TCP connection from {addr[0]}:{addr[1]} closed: {str(e)}")
+        finally:
+            writer.close()
+
+    @property
+    def shed(self) -> int:
+        """
+        Number of requests turned away because the request queue was full.
+        """
+        return self.protocol.shed if self.protocol is not None else 0
+
+    def _sender(self, request: CommonRequest) -> Contact:
+        """
+        Returns the interned contact of the peer that sent the request, at the address it gave.
+        """
+        client = self.client if self.client is not None else UDPClient.default()
+        return client.contacts.intern(
+            request.sender,
+            request.sender_host,
+            request.sender_port,
+            lambda host, port: UDPProtocol(host, port, client=self.client),
+            update_address=True
+        )
+
     async def handle_ping(self, request: CommonRequest) -> PingResponse:
-        contact = Contact(UDPProtocol(request.sender_host, request.sender_port), request.sender, request.sender_host, request.sender_port)
-        self.node.ping(contact)
+        self.node.ping(self._sender(request))
         return PingResponse(random_id=request.random_id)
 
     async def handle_store(self, request:CommonRequest) -> StoreResponse:
-        protocol = UDPProtocol(request.sender_host, request.sender_port)
         await self.node.store(
-            Contact(protocol, request.sender, request.sender_host, request.sender_port),
+            self._sender(request),
             request.key,
             request.value,
             request.exp_time
@@ -77,9 +156,8 @@ class UDPServer:
         return StoreResponse(random_id=request.random_id)
 
     async def handle_find_node(self, request: CommonRequest) -> FindNodeResponse:
-        protocol = UDPProtocol(request.sender_host, request.sender_port)
         contacts, _ = await self.node.find_node(
-            Contact(protocol, request.sender, request.sender_host, request.sender_port),
+            self._sender(request),
             request.key
         )
 
@@ -95,9 +173,8 @@ class UDPServer:
         )
 
     async def handle_find_value(self, request: CommonRequest) -> FindValueResponse:
-        protocol = UDPProtocol(request.sender_host, request.sender_port)
         contacts, value = await self.node.find_value(
-            Contact(protocol, request.sender, request.sender_host, request.sender_port),
+            self._sender(request),
             request.key
         )
         return FindValueResponse(
@@ -113,37 +190,222 @@ class UDPServer:
         )
 
 class UDPServerProtocol(asyncio.DatagramProtocol):
-    def __init__(self, node: 'Node', handlers: dict):
+    '''
+    Queues incoming requests for a fixed number of workers. Requests beyond their source's rate limit are
+    refused before taking a place in the queue, and requests arriving while the queue is full are shed.
+    Binary ones get a cheap error so the sender does not retransmit, JSON ones are dropped.
+    Duplicates of a request answered recently get the same encoded response again, without being handled.
+    '''
+
+    def __init__(self, node: 'Node', handlers: dict, workers: int = SERVER_WORKERS,
+                 queue_size: int = SERVER_QUEUE_SIZE, rate_limiter: RateLimiter = None,
+                 compression: bool = True):
         self.node = node
         self.handlers = handlers
+        self.rate_limiter = rate_limiter
+        self.compression = compression
         self.transport = None
+        # Requests waiting for a worker, with the callback answering those that came over TCP
+        self._queue: asyncio.Queue[tuple[bytes, tuple[str, int], Callable | None]] = asyncio.Queue(queue_size)
+        self._num_workers = workers
+        self._workers: list[asyncio.Task] = []
+        # (addr, random_id) of the requests being handled, to ignore their retransmissions
+        self._in_flight: set[tuple[tuple[str, int], int]] = set()
+        # Encoded responses by (addr, random_id), with the monotonic time they expire and the message id
+        # they were fragmented under, oldest first
+        self._responses: OrderedDict[tuple[tuple[str, int], int], tuple[float, bytes, int | None]] = OrderedDict()
+        self._responses_size = 0
+        # Reassembles fragmented requests and fragments large responses to binary capable peers
+        self._fragments = Fragmenter(self._enqueue, lambda data, addr: self.transport.sendto(data, addr))
+        self.shed = 0
 
     def connection_made(self, transport):
         self.transport = transport
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self._num_workers)]
+
+    def connection_lost(self, exc):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers.clear()
+        self._fragments.close()
 
     def datagram_received(self, data, addr):
-        async def handle():
-            request = None
-            try:
-                request_data = json.loads(data.decode())
-                request = CommonRequest.from_json(json.dumps(request_data["data"]))
-                handler = self.handlers.get(request_data["type"])
-                logger.info(f"Received {request_data['type'].upper()} request from {addr[0]}:{addr[1]}")
+        if not self._fragments.datagram_received(data, addr):
+            self._enqueue(data, addr)
 
-                if not handler:
-                    response = ErrorResponse(random_id=request.random_id, error_message="Unknown request type.")
-                    self.transport.sendto(json.dumps({"type":"error", "data": asdict(response)}).encode(), addr)
-                    return
+    def _reply(self, message: dict, addr: tuple[str, int], binary: bool, compress: bool = False) -> bytes:
+        data = encode(message, binary, compress)
+        self._send(data, addr, binary)
+        return data
 
-                response = await handler(request)
+    def _send(self, data: bytes, addr: tuple[str, int], binary: bool, msg_id: int | None = None) -> int | None:
+        """
+        Sends a response and returns its message id if it was fragmented. Sending it again under that id
+        only sends its first fragment, the client asks for the ones it misses.
+        """
+        if binary:
+            return self._fragments.send(data, addr, msg_id)
+        self.transport.sendto(data, addr)
+        return None
 
-                logger.info(f"Sending {request_data['type'].upper()}_RESPONSE to {addr[0]}:{addr[1]}")
-                self.transport.sendto(json.dumps({"type":request_data["type"]+"_response", "data": asdict(response)}).encode(), addr)
-            except Exception as e:
-                if request is not None:
-                    response = ErrorResponse(random_id=request.random_id, error_message=str(e))
+    def _cached(self, key: tuple[tuple[str, int], int]) -> bytes | None:
+        """
+        Returns the encoded response to a request answered recently.
+        """
+        now = time.monotonic()
+        # Expire from the oldest, every entry lives as long
+        while self._responses:
+            oldest, (expires, data, _) = next(iter(self._responses.items()))
+            if expires > now:
+                break
+            del self._responses[oldest]
+            self._responses_size -= len(data)
+
+        entry = self._responses.get(key)
+        return entry[1] if entry is not None else None
+
+    def _fragment_id(self, key: tuple[tuple[str, int], int]) -> int | None:
+        """
+        Returns the message id a cached response was fragmented under, if it was.
+        """
+        entry = self._responses.get(key)
+        return entry[2] if entry is not None else None
+
+    def _remember(self, key: tuple[tuple[str, int], int], data: bytes, msg_id: int | None = None):
+        if key in self._responses or len(data) > RESPONSE_CACHE_SIZE:
+            return
+        self._responses[key] = (time.monotonic() + RESPONSE_CACHE_TTL, data, msg_id)
+        self._responses_size += len(data)
+        while self._responses_size > RESPONSE_CACHE_SIZE:
+            _, (_, old, _) = self._responses.popitem(last=False)
+            self._responses_size -= len(old)
+
+    def _enqueue(self, data: bytes, addr: tuple[str, int]):
+        # Binary duplicates are answered before reaching the queue, from the random_id in the header
+        random_id = peek_random_id(data)
+        if random_id is not None and (cached := self._cached((addr, random_id))) is not None:
+            logger.info(f"Replaying response to duplicate request from {addr[0]}:{addr[1]}")
+            self._send(cached, addr, True, self._fragment_id((addr, random_id)))
+            return
+
+        self.submit(data, addr)
+
+    def submit(self, data: bytes, addr: tuple[str, int],
+               reply: Callable[[dict | bytes | None], None] | None = None) -> bool:
+        """
+        Queues a request for the workers. Its response is sent back as a datagram, or passed to reply.
+        Returns False if the request was refused, because its source is over its rate limit or the queue
+        is full, in which case it is answered right away.
+        """
+        type = self._peek_type(data)
+        if self.rate_limiter is not None and not self.rate_limiter.allow(addr[0], type):
+            logger.warning(f"Rate limiting {str(type).upper()} request from {addr[0]}:{addr[1]}")
+            self._refuse(data, addr, reply, "Rate limited.")
+            return False
+
+        try:
+            self._queue.put_nowait((data, addr, reply))
+            return True
+        except asyncio.QueueFull:
+            self.shed += 1
+            logger.warning(f"Request queue full, shedding request from {addr[0]}:{addr[1]}")
+            self._refuse(data, addr, reply, "Server busy.")
+            return False
+
+    @staticmethod
+    def _peek_type(data: bytes) -> str | None:
+        """
+        Returns the type of a request, from the header of binary ones.
+        """
+        if is_binary(data):
+            return peek_type(data)
+        try:
+            return json.loads(data).get("type")
+        except (ValueError, AttributeError):
+            return None
+
+    def _refuse(self, data: bytes, addr: tuple[str, int], reply: Callable | None, error_message: str):
+        """
+        Answers a request that is not handled. Refusals are not cached, a retransmission gets another chance.
+        """
+        random_id = peek_random_id(data)
+        response = None
+        if random_id is not None:
+            response = {"type": "error", "data": asdict(ErrorResponse(random_id=random_id,
+                                                                       error_message=error_message))}
+        if reply is not None:
+            reply(response)
+        elif response is not None:
+            self._reply(response, addr, True)
+
+    async def _work(self):
+        while True:
+            data, addr, reply = await self._queue.get()
+            message = None
+            try:
+                if reply is None:
+                    await self.handle(data, addr)
                 else:
-                    response = ErrorResponse(random_id=0, error_message="Invalid Protocol.")
-                logger.error(f"Sending error to {addr[0]}:{addr[1]}: {str(e)}")
-                self.transport.sendto(json.dumps({"type": "error", "data": asdict(response)}).encode(), addr)
-        asyncio.create_task(handle())
\ No newline at end of file
+                    message = await self.respond(data, addr)
+            except Exception as e:
+                logger.error(f"Failed to handle request from {addr[0]}:{addr[1]}: {str(e)}")
+            finally:
+                if reply is not None:
+                    reply(message)
+
+    async def handle(self, data: bytes, addr: tuple[str, int]):
+        # Answer in the encoding the request came in
+        binary = is_binary(data)
+        message = await self.respond(data, addr)
+        if isinstance(message, bytes):
+            msg_id = self._fragment_id((addr, peek_random_id(data))) if binary else None
+            self._send(message, addr, binary, msg_id)
+        elif message is not None:
+            encoded = encode(message, binary, self.compression and accepts_compression(data))
+            msg_id = self._send(encoded, addr, binary)
+            self._remember((addr, message["data"]["random_id"]), encoded, msg_id)
+
+    async def respond(self, data: bytes, addr: tuple[str, int]) -> dict | bytes | None:
+        """
+        Handles an encoded request and returns the response message, the encoded response if the request
+        was answered recently, or None if the request is ignored.
+        """
+        request = None
+        in_flight = None
+        try:
+            request_data = decode(data)
+            request = CommonRequest(**request_data["data"])
+
+            cached = self._cached((addr, request.random_id))
+            if cached is not None:
+                logger.info(f"Replaying response to duplicate request from {addr[0]}:{addr[1]}")
+                return cached
+
+            # A retransmission of a request we are still handling gets the original's response
+            if (addr, request.random_id) in self._in_flight:
+                logger.info(f"Ignoring retransmitted request from {addr[0]}:{addr[1]}")
+                return None
+            in_flight = (addr, request.random_id)
+            self._in_flight.add(in_flight)
+
+            handler = self.handlers.get(request_data["type"])
+            logger.info(f"Received {request_data['type'].upper()} request from {addr[0]}:{addr[1]}")
+
+            if not handler:
+                response = ErrorResponse(random_id=request.random_id, error_message="Unknown request type.")
+                return {"type":"error", "data": asdict(response)}
+
+            response = await handler(request)
+
+            logger.info(f"Sending {request_data['type'].upper()}_RESPONSE to {addr[0]}:{addr[1]}")
+            return {"type":request_data["type"]+"_response", "data": asdict(response)}
+        except Exception as e:
+            if request is not None:
+                response = ErrorResponse(random_id=request.random_id, error_message=str(e))
+            else:
+                response = ErrorResponse(random_id=0, error_message="Invalid Protocol.")
+            logger.error(f"Sending error to {addr[0]}:{addr[1]}: {str(e)}")
+            return {"type": "error", "data": asdict(response)}
+        finally:
+            if in_flight is not None:
+                self._in_flight.discard(in_flight)
@@ -0,0 +1,245 @@
+import json
+import socket
+import struct
+import zlib
+
+from hermes.kademlia.Support import COMPRESSION_THRESHOLD, COMPRESSION_LEVEL, MAX_MESSAGE_SIZE
+
+# Versioned binary encoding of the RPC messages, with JSON kept for peers that do not speak it.
+#
+# Binary layout, big endian:
+#   header     magic (1) version (1) type (1) flags (1) random_id (20)
+#              flags: bit 0 the rest of the message is zlib compressed,
+#                     bit 1 the sender decodes compressed messages
+#   requests   sender (20) sender ipv4 (4) sender port (2)
+#              find_node, find_value: key (20)
+#              store: key (20) exp_time (8) value length (4) value
+#   responses  find_node: count (2) then count * (id (20) ipv4 (4) port (2))
+#              find_value: presence (1, bit 0 contacts, bit 1 value) then the contacts as above,
+#                          then value length (4) value
+#              error: message length (2) message
+#
+# JSON messages carry a "wire" field with the highest binary version the sender decodes,
+# which is how peers find out they can switch to the binary encoding. Compression is only
+# used towards peers whose binary messages set the accepts compressed flag.
+
+WIRE_VERSION = 1
+
+# Never the first byte of a JSON document
+MAGIC = 0xC8
+
+ID_SIZE = 20
+
+TYPES = {
+    "find_node": 0x01,
+    "find_value": 0x02,
+    "ping": 0x03,
+    "store": 0x04,
+    "find_node_response": 0x81,
+    "find_value_response": 0x82,
+    "ping_response": 0x83,
+    "store_response": 0x84,
+    "error": 0xFF,
+}
+_NAMES = {code: name for name, code in TYPES.items()}
+
+_HEADER = struct.Struct("!BBBB")
+_ADDR = struct.Struct("!4sH")
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_U64 = struct.Struct("!Q")
+
+_HAS_CONTACTS = 0x01
+_HAS_VALUE = 0x02
+
+FLAG_COMPRESSED = 0x01
+FLAG_ACCEPTS_COMPRESSED = 0x02
+
+class WireError(ValueError):
+    pass
+
+def is_binary(data) -> bool:
+    return len(data) > 0 and data[0] == MAGIC
+
+def peek_random_id(data) -> int | None:
+    """
+    Returns the random_id of a binary message without decoding the rest of it.
+    """
+    if not is_binary(data) or len(data) < _HEADER.size + ID_SIZE:
+        return None
+    return int.from_bytes(data[_HEADER.size:_HEADER.size + ID_SIZE], "big")
+
+def peek_type(data) -> str | None:
+    """
+    Returns the type of a binary message without decoding the rest of it.
+    """
+    if not is_binary(data) or len(data) < _HEADER.size:
+        return None
+    return _NAMES.get(data[2])
+
+def accepts_compression(data) -> bool:
+    """
+    Whether the sender of a message decodes compressed messages.
+    """
+    return is_binary(data) and len(data) >= _HEADER.size and bool(data[3] & FLAG_ACCEPTS_COMPRESSED)
+
+def encode(message: dict, binary: bool = False, compress: bool = False) -> bytes:
+    """
+    Encodes a {"type", "data"} message. Binary is used when asked for and the message fits it
+    (ids of at most 160 bits, IPv4 addresses), JSON otherwise. Large binary messages are
+    compressed if asked for.
+    """
+    if binary:
+        try:
+            return encode_binary(message, compress)
+        except (KeyError, TypeError, ValueError, OverflowError, OSError, struct.error):
+            pass
+    return json.dumps({**message, "wire": WIRE_VERSION}).encode()
+
+def decode(data) -> dict:
+    """
+    Decodes a datagram in either encoding into a {"type", "data"} message.
+
+    Raises:
+        WireError: If a binary message is malformed.
+    """
+    if is_binary(data):
+        return decode_binary(data)
+    return json.loads(data)
+
+def encode_binary(message: dict, compress: bool = False) -> bytes:
+    type = message["type"]
+    data = message["data"]
+    code = TYPES[type]
+
+    out = bytearray()
+
+    if code < 0x80:
+        out += _pack_id(data["sender"])
+        out += _pack_addr(data["sender_host"], data["sender_port"])
+        if type in ("find_node", "find_value", "store"):
+            out += _pack_id(data["key"])
+        if type == "store":
+            out += _U64.pack(data["exp_time"])
+            out += _pack_text(data["value"], _U32)
+    elif type == "find_node_response":
+        out += _pack_contacts(data["contacts"] or [])
+    elif type == "find_value_response":
+        contacts, value = data["contacts"], data["value"]
+        out += _U8.pack((_HAS_CONTACTS if contacts is not None else 0) | (_HAS_VALUE if value is not None else 0))
+        if contacts is not None:
+            out += _pack_contacts(contacts)
+        if value is not None:
+            out += _pack_text(value, _U32)
+    elif type == "error":
+        out += _pack_text(data["error_message"], _U16)
+
+    flags = FLAG_ACCEPTS_COMPRESSED
+    if compress and len(out) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(out, COMPRESSION_LEVEL)
+        if len(compressed) < len(out):
+            out = compressed
+            flags |= FLAG_COMPRESSED
+
+    # The random_id stays uncompressed, so it can be read without decoding the message
+    return _HEADER.pack(MAGIC, WIRE_VERSION, code, flags) + _pack_id(data["random_id"]) + bytes(out)
+
+def decode_binary(data) -> dict:
+    view = memoryview(data)
+    try:
+        _, version, code, flags = _HEADER.unpack_from(view, 0)
+        if version != WIRE_VERSION:
+            raise WireError(f"Unsupported wire version {version}.")
+        if code not in _NAMES:
+            raise WireError(f"Unknown message type {code}.")
+        type = _NAMES[code]
+
+        offset = _HEADER.size
+        random_id, offset = _read_id(view, offset)
+        data = {"random_id": random_id}
+
+        if flags & FLAG_COMPRESSED:
+            view, offset = memoryview(_inflate(view[offset:])), 0
+
+        if code < 0x80:
+            data["protocol_name"] = "UDPProtocol"
+            data["sender"], offset = _read_id(view, offset)
+            (data["sender_host"], data["sender_port"]), offset = _read_addr(view, offset)
+            if type in ("find_node", "find_value", "store"):
+                data["key"], offset = _read_id(view, offset)
+            if type == "store":
+                (data["exp_time"],) = _U64.unpack_from(view, offset)
+                offset += _U64.size
+                data["value"], offset = _read_text(view, offset, _U32)
+        elif type == "find_node_response":
+            data["contacts"], offset = _read_contacts(view, offset)
+        elif type == "find_value_response":
+            (present,) = _U8.unpack_from(view, offset)
+            offset += _U8.size
+            data["contacts"], data["value"] = None, None
+            if present & _HAS_CONTACTS:
+                data["contacts"], offset = _read_contacts(view, offset)
+            if present & _HAS_VALUE:
+                data["value"], offset = _read_text(view, offset, _U32)
+        elif type == "error":
+            data["error_message"], offset = _read_text(view, offset, _U16)
+
+        return {"type": type, "data": data}
+    except (struct.error, UnicodeDecodeError, OSError, zlib.error) as e:
+        raise WireError(f"Malformed message: {str(e)}") from e
+
+def _inflate(data: memoryview) -> bytes:
+    inflater = zlib.decompressobj()
+    body = inflater.decompress(data, MAX_MESSAGE_SIZE)
+    if inflater.unconsumed_tail:
+        raise WireError("Message too large once decompressed.")
+    return body
+
+def _pack_id(value: int) -> bytes:
+    return value.to_bytes(ID_SIZE, "big")
+
+def _pack_addr(host: str, port: int) -> bytes:
+    return _ADDR.pack(socket.inet_pton(socket.AF_INET, host), port)
+
+def _pack_text(text: str, length: struct.Struct) -> bytes:
+    if not isinstance(text, str):
+        raise TypeError("Expected a string.")
+    raw = text.encode()
+    return length.pack(len(raw)) + raw
+
+def _pack_contacts(contacts: list[dict]) -> bytes:
+    out = bytearray(_U16.pack(len(contacts)))
+    for c in contacts:
+        out += _pack_id(c["contact"])
+        out += _pack_addr(c["host"], c["port"])
+    return bytes(out)
+
+def _take(view: memoryview, offset: int, size: int) -> memoryview:
+    if offset + size > len(view):
+        raise WireError("Truncated message.")
+    return view[offset:offset + size]
+
+def _read_id(view: memoryview, offset: int) -> (int, int):
+    return int.from_bytes(_take(view, offset, ID_SIZE), "big"), offset + ID_SIZE
+
+def _read_addr(view: memoryview, offset: int) -> ((str, int), int):
+    raw = _take(view, offset, _ADDR.size)
+    host = socket.inet_ntop(socket.AF_INET, raw[:4])
+    (port,) = _U16.unpack_from(raw, 4)
+    return (host, port), offset + _ADDR.size
+
+def _read_text(view: memoryview, offset: int, length: struct.Struct) -> (str, int):
+    (size,) = length.unpack_from(view, offset)
+    offset += length.size
+    return str(_take(view, offset, size), "utf-8"), offset + size
+
+def _read_contacts(view: memoryview, offset: int) -> (list[dict], int):
+    (count,) = _U16.unpack_from(view, offset)
+    offset += _U16.size
+    contacts = []
+    for _ in range(count):
+        id, offset = _read_id(view, offset)
+        (host, port), offset = _read_addr(view, offset)
+        contacts.append({"contact": id, "host": host, "port": port})
+    return contacts, offset
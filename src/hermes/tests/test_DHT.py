@@ -1,3 +1,8 @@
+import asyncio
+import datetime
+import gc
+import time
+
 import pytest
 import logging
 
@@ -10,8 +15,10 @@ from hermes.kademlia.KBucket import KBucket
 from hermes.kademlia.BucketList import BucketList
 from hermes.kademlia.Protocol import Protocol
 from hermes.kademlia.Router import Router
+from hermes.kademlia.RPCError import RPCError
+from hermes.kademlia.Shortlist import Shortlist
 from hermes.crypt.Crypt import Crypt
-from hermes.kademlia.Support import K_VAL
+from hermes.kademlia.Support import K_VAL, CIRCUIT_FAILURES, EVICTION_FAILURES, CIRCUIT_RESET_TIMEOUT
 from hermes.kademlia.Node import Node
 from hermes.kademlia.Storage import Storage
 
@@ -236,4 +243,322 @@ async def test_get_value_propagates_to_closer_nodes():
     # should be found.
     assert found
     # Should be in node 3
-    assert store3.contains(key)
\ No newline at end of file
+    assert store3.contains(key)
+
+class DelayedProtocol(Protocol):
+    """
+    Virtual protocol answering after a delay, to observe concurrent RPCs.
+    """
+    def __init__(self, delay: float, node: Node = None):
+        super().__init__(node=node)
+        self.delay = delay
+        self.cancelled = False
+        self.calls = 0
+
+    async def find_value(self, sender, key):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return await super().find_value(sender, key)
+
+    async def store(self, sender, key, val, exp_time=0):
+        await asyncio.sleep(self.delay)
+        return await super().store(sender, key, val, exp_time)
+
+    async def find_node(self, sender, key):
+        await asyncio.sleep(self.delay)
+        return await super().find_node(sender, key)
+
+@pytest.mark.asyncio
+async def test_lookup_queries_concurrently():
+    us = Contact(Protocol(), 2**160, 'host', 1)
+    router = Router(Node(us, Storage()))
+
+    fast = DelayedProtocol(0.2)
+    fast.node = Node(Contact(fast, 2**159, 'host', 1), Storage())
+    fast.node.storage.set(0, "Test")
+    slow = DelayedProtocol(5)
+    slow.node = Node(Contact(slow, 2**158, 'host', 1), Storage())
+
+    await router.node.bucket_list.add_contact(fast.node.our_contact)
+    await router.node.bucket_list.add_contact(slow.node.our_contact)
+
+    start = time.monotonic()
+    found, contacts, found_by, val = await router.lookup(0, router.rpc_find_value)
+
+    # Answered by the fast peer without waiting on the slow one
+    assert found and val == "Test"
+    assert found_by.id == 2**159
+    assert time.monotonic() - start < 1
+    await asyncio.sleep(0)
+    assert slow.cancelled
+
+@pytest.mark.asyncio
+async def test_store_returns_on_write_quorum():
+    vp = Protocol()
+    dht = DHT(2**160, vp, Storage(), write_quorum=1)
+
+    fast = DelayedProtocol(0.1)
+    fast.node = Node(Contact(fast, 2**159, 'host', 1), Storage())
+    slow = DelayedProtocol(1)
+    slow.node = Node(Contact(slow, 2**158, 'host', 1), Storage())
+    await dht.router.node.bucket_list.add_contact(fast.node.our_contact)
+    await dht.router.node.bucket_list.add_contact(slow.node.our_contact)
+
+    start = time.monotonic()
+    assert await dht.store(0, "Test")
+
+    # Acknowledged by the fast replica, the slow one still storing in the background
+    assert time.monotonic() - start < 0.5
+    assert fast.node.storage.get(0) == "Test"
+    assert not slow.node.storage.contains(0)
+
+    await asyncio.sleep(1.2)
+    assert slow.node.storage.get(0) == "Test"
+
+class FailingProtocol(Protocol):
+    async def store(self, sender, key, val, exp_time=0):
+        raise ConnectionError("Unreachable.")
+
+    async def find_node(self, sender, key):
+        return [], RPCError(timeout_error=True)
+
+@pytest.mark.asyncio
+async def test_store_reports_missed_write_quorum():
+    vp = Protocol()
+    dht = DHT(2**160, vp, Storage(), write_quorum=2)
+
+    alive = Protocol()
+    alive.node = Node(Contact(alive, 2**159, 'host', 1), Storage())
+    dead = Contact(FailingProtocol(), 2**158, 'host', 1)
+    await dht.router.node.bucket_list.add_contact(alive.node.our_contact)
+    await dht.router.node.bucket_list.add_contact(dead)
+
+    # One of the two replicas failed, reported as a failure of its contact
+    assert not await dht.store(0, "Test")
+    assert alive.node.storage.get(0) == "Test"
+    assert dead.failures == 1
+
+@pytest.mark.asyncio
+async def test_store_without_contacts_misses_write_quorum():
+    vp = Protocol()
+    dht = DHT(2**160, vp, Storage(), write_quorum=1)
+
+    # Only stored locally
+    assert not await dht.store(0, "Test")
+    assert dht.router.node.storage.get(0) == "Test"
+
+@pytest.mark.asyncio
+async def test_store_on_fewer_replicas_than_write_quorum():
+    vp = Protocol()
+    dht = DHT(2**160, vp, Storage(), write_quorum=3)
+
+    replicas = []
+    for i in range(2):
+        replica = Protocol()
+        replica.node = Node(Contact(replica, 2**(159 - i), 'host', 1), Storage())
+        await dht.router.node.bucket_list.add_contact(replica.node.our_contact)
+        replicas.append(replica)
+
+    # Both replicas store the value, but that is not a quorum of three
+    assert not await dht.store(0, "Test")
+    await asyncio.sleep(0)
+    assert all(r.node.storage.get(0) == "Test" for r in replicas)
+
+@pytest.mark.asyncio
+async def test_failures_outlive_lookups():
+    vp = Protocol()
+    dht = DHT(2**160, vp, Storage())
+    registry = dht._client.contacts
+
+    # A peer in our buckets pointing at a dead one, interned anew from every answer as received over the wire
+    class Referrer(Protocol):
+        async def find_node(self, sender, key):
+            return [registry.intern(2**158, 'host', 2, lambda h, p: FailingProtocol())], RPCError()
+    referrer = Contact(Referrer(), 2**159, 'host', 1)
+    await dht.router.node.bucket_list.add_contact(referrer)
+
+    for _ in range(CIRCUIT_FAILURES):
+        await dht.router.lookup(0, dht.router.rpc_find_nodes)
+        gc.collect()
+
+    # Only the registry refers to the dead peer between lookups, its failures add up all the same
+    dead = registry.get(2**158)
+    assert dead is not None and dead not in dht.router.node.bucket_list.get_kbucket(dead.id).contacts
+    assert dead.failures == CIRCUIT_FAILURES
+    assert dead.circuit_open
+
+@pytest.mark.asyncio
+async def test_bootstrap_from_seeds_concurrently():
+    vp = Protocol()
+    dht = DHT(1, vp, Storage(), ready_contacts=4)
+    vp.node = dht.router.node
+
+    # Two seeds answering slowly, each knowing two other peers
+    seeds = []
+    for i in range(2):
+        seed = DelayedProtocol(0.3)
+        seed.node = Node(Contact(seed, 2**(159 - 2 * i), 'host', 1), Storage())
+        for j in range(2):
+            peer = Protocol()
+            peer.node = Node(Contact(peer, 2**(158 - 2 * i) + j, 'host', 1), Storage())
+            await seed.node.bucket_list.add_contact(peer.node.our_contact)
+        seeds.append(seed.node.our_contact)
+
+    assert not dht.ready
+    start = time.monotonic()
+    task = asyncio.create_task(dht.bootstrap(seeds))
+
+    # Both seeds queried at once, ready as soon as they answered
+    assert await dht.wait_ready(0.5)
+    assert time.monotonic() - start < 0.5
+    assert dht.router.node.bucket_list.get_num_contacts() >= 4
+
+    error = await task
+    assert not error.has_error()
+
+@pytest.mark.asyncio
+async def test_failed_bootstrap_is_not_ready():
+    vp = Protocol()
+    dht = DHT(1, vp, Storage())
+    vp.node = dht.router.node
+
+    seed = Contact(FailingProtocol(), 2**159, 'host', 1)
+    waiting = asyncio.create_task(dht.wait_ready(1))
+
+    # Waiting clients are let go, but told no seed could be joined
+    error = await dht.bootstrap(seed)
+    assert error.has_error()
+    assert not await waiting
+    assert not dht.ready
+
+@pytest.mark.asyncio
+async def test_refresh_only_stale_buckets():
+    vp = Protocol()
+    dht = DHT(1, vp, Storage(), refresh_interval=60000, refresh_budget=2)
+    vp.node = dht.router.node
+
+    for i in range(4):
+        peer = Protocol()
+        peer.node = Node(Contact(peer, 2**(159 - i), 'host', 1), Storage())
+        await dht.router.node.bucket_list.add_contact(peer.node.our_contact)
+
+    buckets = dht.router.node.bucket_list.buckets
+    assert len(buckets) >= 4
+    hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+    for i, bucket in enumerate(buckets[:3]):
+        bucket.timestamp = hour_ago - datetime.timedelta(minutes=i)
+    fresh = {id(b): b.timestamp for b in buckets[3:]}
+
+    assert dht.stale_buckets() == [buckets[2], buckets[1], buckets[0]]
+
+    # The two oldest within the budget, the last one on the next round
+    assert await dht.refresh_stale_buckets() == 2
+    assert dht.stale_buckets() == [buckets[0]]
+    assert await dht.refresh_stale_buckets() == 1
+    assert dht.stale_buckets() == []
+    assert all(b.timestamp == fresh[id(b)] for b in buckets[3:])
+
+@pytest.mark.asyncio
+async def test_failing_contact_skipped_then_evicted():
+    vp = Protocol()
+    dht = DHT(1, vp, Storage())
+    bucket_list = dht.router.node.bucket_list
+
+    dead = Contact(Protocol(), 2**159, 'host', 1)
+    alive = Contact(Protocol(), 2**159 + 2**158, 'host', 1)
+    replacement = Contact(Protocol(), 2**159 + 1, 'host', 1)
+    await bucket_list.add_contacts([dead, alive])
+    bucket = bucket_list.get_kbucket(dead.id)
+    bucket.add_replacement(replacement)
+
+    for _ in range(CIRCUIT_FAILURES):
+        dht.handle_error(RPCError(timeout_error=True), dead)
+
+    # Circuit open: skipped by lookups but still in its bucket
+    assert dead.circuit_open
+    assert dead not in await bucket_list.get_close_contacts(dead.id, 1)
+    assert not Shortlist(dead.id).add(dead)
+    assert bucket.contains(dead.id)
+
+    for _ in range(EVICTION_FAILURES - CIRCUIT_FAILURES):
+        dht.handle_error(RPCError(timeout_error=True), dead)
+    await asyncio.sleep(0)
+
+    assert not bucket.contains(dead.id)
+    assert bucket.contains(replacement.id)
+
+    # A success closes the circuit again
+    dht.handle_error(RPCError(), dead)
+    assert not dead.circuit_open and dead.failures == 0
+
+@pytest.mark.asyncio
+async def test_concurrent_find_value_coalesced():
+    vp = Protocol()
+    dht = DHT(2**160, vp, Storage())
+
+    peer = DelayedProtocol(0.2)
+    peer.node = Node(Contact(peer, 2**159, 'host', 1), Storage())
+    peer.node.storage.set(0, "Test")
+    await dht.router.node.bucket_list.add_contact(peer.node.our_contact)
+
+    results = await asyncio.gather(*(dht.find_value(0) for _ in range(5)))
+
+    # A single lookup answered every caller
+    assert all(r == (True, None, "Test") for r in results)
+    assert peer.calls == 1
+
+    # Later lookups run again
+    await dht.find_value(0)
+    assert peer.calls == 2
+
+@pytest.mark.asyncio
+async def test_looked_up_bucket_is_not_stale():
+    vp = Protocol()
+    dht = DHT(1, vp, Storage(), refresh_interval=60000)
+    vp.node = dht.router.node
+
+    for i in range(4):
+        peer = Protocol()
+        peer.node = Node(Contact(peer, 2**(159 - i), 'host', 1), Storage())
+        await dht.router.node.bucket_list.add_contact(peer.node.our_contact)
+
+    buckets = dht.router.node.bucket_list.buckets
+    hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+    for bucket in buckets:
+        bucket.timestamp = hour_ago
+
+    # Looking up a key counts as a refresh of its bucket
+    key = 2**159 + 5
+    await dht.find_value(key)
+    looked_up = dht.router.node.bucket_list.get_kbucket(key)
+    assert looked_up not in dht.stale_buckets()
+    assert len(dht.stale_buckets()) == len(buckets) - 1
+
+def test_half_open_circuit_lets_one_probe_through():
+    dead = Contact(Protocol(), 2**159, 'host', 1)
+    for _ in range(CIRCUIT_FAILURES):
+        dead.record_failure()
+    assert dead.circuit_open and not dead.try_request()
+
+    # Once the reset timeout passed, only the first of two lookups queries the peer
+    dead.opened_at -= CIRCUIT_RESET_TIMEOUT
+    lookups = [Shortlist(0), Shortlist(0)]
+    for shortlist in lookups:
+        shortlist.add(dead)
+    assert lookups[0].next_candidate() is dead
+    assert lookups[1].next_candidate() is None
+    assert dead.circuit_open
+
+    # The probe failed, the circuit is fully open again
+    dead.record_failure()
+    assert dead.circuit_open
+    dead.opened_at -= CIRCUIT_RESET_TIMEOUT
+    assert dead.try_request() and not dead.try_request()
+
+    # The next probe succeeded
+    dead.record_success()
+    assert not dead.circuit_open and dead.try_request() and dead.try_request()
@@ -0,0 +1,131 @@
+import asyncio
+import random
+
+import pytest
+import logging
+
+import struct
+
+from hermes.net.Fragment import Fragmenter, is_fragment, split, FRAGMENT_MAGIC, BUFFER_OVERHEAD
+from hermes.kademlia.Support import MAX_NACKS
+
+logging.basicConfig(level=logging.INFO)
+
+def test_split_fragments():
+    data = bytes(random.getrandbits(8) for _ in range(2500))
+    fragments = split(data, 7, size=1000)
+
+    assert len(fragments) == 3
+    assert all(is_fragment(f) for f in fragments)
+    assert b"".join(f[10:] for f in fragments) == data
+
+@pytest.mark.asyncio
+async def test_lost_fragments_are_resent_selectively():
+    a_addr, b_addr = ("10.0.0.1", 1), ("10.0.0.2", 2)
+    delivered = []
+    sent_by_a = []
+    # The 2nd and 4th fragments of the first transmission are lost
+    lost = {1, 3}
+
+    def a_sendto(data, addr):
+        sent_by_a.append(data)
+        if len(sent_by_a) - 1 not in lost:
+            b.datagram_received(data, a_addr)
+
+    a = Fragmenter(lambda data, addr: None, a_sendto, size=100)
+    b = Fragmenter(lambda data, addr: delivered.append(data), lambda data, addr: a.datagram_received(data, b_addr),
+                   size=100)
+
+    data = bytes(random.getrandbits(8) for _ in range(550))
+    a.send(data, b_addr)
+    assert len(sent_by_a) == 6
+    assert delivered == []
+
+    # b asks for the missing fragments once they stop coming, and only those are sent again
+    await asyncio.sleep(0.3)
+    assert delivered == [data]
+    assert len(sent_by_a) == 8
+
+    a.close()
+    b.close()
+
+@pytest.mark.asyncio
+async def test_lost_burst_is_resent_whole():
+    a_addr, b_addr = ("10.0.0.1", 1), ("10.0.0.2", 2)
+    delivered = []
+    sent_by_a = []
+    # The whole first transmission is lost, and the receiver never learns of it
+    lost = set(range(6))
+
+    def a_sendto(data, addr):
+        sent_by_a.append(data)
+        if len(sent_by_a) - 1 not in lost:
+            b.datagram_received(data, a_addr)
+
+    a = Fragmenter(lambda data, addr: None, a_sendto, size=100)
+    b = Fragmenter(lambda data, addr: delivered.append(data), lambda data, addr: a.datagram_received(data, b_addr),
+                   size=100)
+
+    data = bytes(random.getrandbits(8) for _ in range(550))
+    msg_id = a.send(data, b_addr)
+    assert delivered == []
+
+    # Sent again without a NACK since, so all of it goes out
+    assert a.send(data, b_addr, msg_id) == msg_id
+    assert len(sent_by_a) == 12
+    assert delivered == [data]
+
+    a.close()
+    b.close()
+
+@pytest.mark.asyncio
+async def test_reassembly_memory_is_bounded():
+    delivered = []
+    max_bytes = 2 * (100 + BUFFER_OVERHEAD) + 50
+    b = Fragmenter(lambda data, addr: delivered.append(data), lambda data, addr: None, size=100, max_bytes=max_bytes)
+
+    # The first fragments of three messages, more than the buffers hold
+    for msg_id in range(3):
+        b.datagram_received(split(bytes(300), msg_id, size=100)[0], ("10.0.0.1", 1))
+
+    assert b._buffered <= max_bytes
+    assert len(b._buffers) == 2
+    b.close()
+
+@pytest.mark.asyncio
+async def test_spoofed_fragments_are_not_amplified():
+    sent = []
+    b = Fragmenter(lambda data, addr: None, lambda data, addr: sent.append(data), size=100, max_buffers=4)
+    victim = ("10.0.0.9", 9)
+
+    def header(msg_id):
+        return struct.pack("!BBIHH", FRAGMENT_MAGIC, 0, msg_id, 0, 0xFFFF)
+
+    # Bare headers claiming huge messages are dropped
+    for msg_id in range(100):
+        b.datagram_received(header(msg_id), victim)
+    assert len(b._buffers) == 0
+
+    # Full fragments of huge messages are buffered, but only a bounded number of them
+    for msg_id in range(100):
+        b.datagram_received(header(msg_id) + bytes(100), victim)
+    assert len(b._buffers) == 4
+
+    # Too little of the messages arrived to ask for the rest, even when probed
+    b.datagram_received(header(99) + bytes(100), victim)
+    await asyncio.sleep(0.5)
+    assert sent == []
+    b.close()
+
+@pytest.mark.asyncio
+async def test_nacks_stop_without_progress():
+    sent = []
+    b = Fragmenter(lambda data, addr: None, lambda data, addr: sent.append(data), size=100, timeout=5)
+
+    # Half of the message arrived, the rest never does
+    for fragment in split(bytes(1000), 1, size=100)[:5]:
+        b.datagram_received(fragment, ("10.0.0.1", 1))
+    await asyncio.sleep(1)
+
+    assert len(sent) == MAX_NACKS
+    b.close()
@@ -1,4 +1,6 @@
+import asyncio
 from importlib.util import source_hash
+import random
 
 import pytest
 import logging
@@ -12,7 +14,7 @@ from hermes.kademlia.KBucket import KBucket
 from hermes.kademlia.BucketList import BucketList
 from hermes.kademlia.Protocol import Protocol
 from hermes.kademlia.Router import Router
-from hermes.kademlia.Support import K_VAL
+from hermes.kademlia.Support import K_VAL, CONTACT_FRESHNESS
 from hermes.kademlia.Node import Node
 from hermes.kademlia.Storage import Storage
 
@@ -26,6 +28,39 @@ def test_kbucket_full():
     with pytest.raises(Exception):
         k.add_contact(Contact(None, K_VAL+1, 'host', 1))
 
+def test_kbucket_refresh_moves_to_tail():
+    k = KBucket()
+    for i in range(K_VAL):
+        k.add_contact(Contact(None, i, 'host', 1))
+
+    assert k.head().id == 0
+    k.replace_contact(Contact(None, 0, 'other', 2))
+
+    # Refreshed contact is now the most recently seen
+    assert k.contacts[-1].id == 0
+    assert k.contacts[-1].host == 'other'
+    assert k.head().id == 1
+    assert k.remove_contact(1).id == 1
+    assert not k.contains(1)
+
+def test_kbucket_depth():
+    k = KBucket()
+    assert k.depth() == 0
+
+    # Ids of differing bit lengths are compared at the full id width
+    k.add_contact(Contact(None, 0b1, 'host', 1))
+    k.add_contact(Contact(None, 0b110, 'host', 1))
+    assert k.depth() == 157
+
+    k.remove_contact(0b110)
+    assert k.depth() == 160
+
+    k1 = KBucket(0, 2**160 - 1)
+    k1.contacts = [Contact(None, 2**159, 'host', 1), Contact(None, 2**159 + 2**150, 'host', 1)]
+    assert k1.depth() == 9
+    a, b = k1.split()
+    assert b.depth() == 9 and a.depth() == 0
+
 def test_force_fail_add():
     contact = Contact(None, 1, 'host', 1)
     node = Node(contact, Storage())
@@ -62,3 +97,113 @@ async def test_split():
 
 
 
+@pytest.mark.asyncio
+async def test_get_kbucket_after_splits():
+    bucket_list = BucketList(2**159 + 12345)
+
+    for _ in range(200):
+        await bucket_list.add_contact(Contact(None, random.randint(0, 2**160), 'host', 1))
+
+    assert len(bucket_list.buckets) > 1
+    for _ in range(200):
+        key = random.randint(0, 2**160)
+        bucket = bucket_list.get_kbucket(key)
+        assert bucket.has_in_range(key)
+        assert [b for b in bucket_list.buckets if b.has_in_range(key)] == [bucket]
+
+    assert bucket_list.get_kbucket_index(-1) is None
+    assert bucket_list.get_kbucket_index(2**160 + 1) is None
+
+@pytest.mark.asyncio
+async def test_close_contacts_match_full_sort():
+    bucket_list = BucketList(random.randint(0, 2**160))
+    contacts = [Contact(None, random.randint(0, 2**160), 'host', 1) for _ in range(300)]
+    for c in contacts:
+        await bucket_list.add_contact(c)
+
+    known = [c for b in bucket_list.buckets for c in b.contacts]
+    for _ in range(100):
+        key = random.randint(0, 2**160)
+        excluded = random.choice(known).id
+        expected = sorted([c for c in known if c.id != excluded], key=lambda c: c.id ^ key)[:K_VAL]
+        assert await bucket_list.get_close_contacts(key, excluded) == expected
+
+@pytest.mark.asyncio
+async def test_full_bucket_evicts_dead_head():
+    us = Contact(Protocol(), 2**160, 'host', 1)
+    bucket_list = BucketList(us.id, us)
+    bucket_list.can_split = lambda kbucket: False
+
+    dead = Contact(Protocol(responds=False), 1, 'host', 1)
+    alive = Contact(Protocol(node=Node(Contact(None, 2, 'host', 1), Storage())), 2, 'host', 1)
+    await bucket_list.add_contact(dead)
+    await bucket_list.add_contact(alive)
+    dead.last_seen -= CONTACT_FRESHNESS
+
+    # Does not fit, kept as a replacement while the oldest contact is checked
+    newcomer = Contact(Protocol(), 3, 'host', 1)
+    await bucket_list.add_contact(newcomer)
+    bucket = bucket_list.get_kbucket(3)
+    assert not bucket.contains(3)
+    assert bucket.replacements == [newcomer]
+
+    await bucket_list._ping_task
+
+    assert not bucket.contains(1)
+    assert bucket.contains(3)
+    assert bucket.replacements == []
+
+@pytest.mark.asyncio
+async def test_full_bucket_does_not_ping_fresh_head():
+    us = Contact(Protocol(), 2**160, 'host', 1)
+    bucket_list = BucketList(us.id, us)
+    bucket_list.can_split = lambda kbucket: False
+
+    await bucket_list.add_contact(Contact(Protocol(), 1, 'host', 1))
+    await bucket_list.add_contact(Contact(Protocol(), 2, 'host', 1))
+
+    # Heard from the head just now, no need to check it
+    for id in range(3, 10):
+        await bucket_list.add_contact(Contact(Protocol(), id, 'host', 1))
+    assert bucket_list._ping_task is None
+    assert bucket_list.get_kbucket(1).contains(1)
+
+@pytest.mark.asyncio
+async def test_close_keeps_contacts_being_pinged():
+    us = Contact(Protocol(), 2**160, 'host', 1)
+    bucket_list = BucketList(us.id, us)
+    bucket_list.can_split = lambda kbucket: False
+
+    class SlowProtocol(Protocol):
+        async def ping(self, sender):
+            await asyncio.sleep(1)
+            raise ConnectionError("UDP client endpoint closed.")
+
+    head = Contact(SlowProtocol(), 1, 'host', 1)
+    await bucket_list.add_contact(head)
+    await bucket_list.add_contact(Contact(Protocol(), 2, 'host', 1))
+    head.last_seen -= CONTACT_FRESHNESS
+    await bucket_list.add_contact(Contact(Protocol(), 3, 'host', 1))
+    await asyncio.sleep(0.1)
+
+    # Shutting down while the head is pinged does not evict it
+    bucket_list.close()
+    with pytest.raises(asyncio.CancelledError):
+        await bucket_list._ping_task
+    assert bucket_list.get_kbucket(1).contains(1)
+
+@pytest.mark.asyncio
+async def test_add_contacts_matches_single_adds():
+    our_id = random.randint(0, 2**160)
+    contacts = [Contact(None, random.randint(0, 2**160), 'host', 1) for _ in range(300)]
+
+    batched = BucketList(our_id)
+    await batched.add_contacts(contacts + contacts[:10])
+
+    single = BucketList(our_id)
+    for c in sorted(contacts, key=lambda c: c.id):
+        await single.add_contact(c)
+
+    assert [(b.low, b.high) for b in batched.buckets] == [(b.low, b.high) for b in single.buckets]
+    assert [[c.id for c in b.contacts] for b in batched.buckets] == [[c.id for c in b.contacts] for b in single.buckets]
+
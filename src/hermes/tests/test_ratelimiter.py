@@ -0,0 +1,27 @@
+import logging
+
+from hermes.net.RateLimiter import RateLimiter
+
+logging.basicConfig(level=logging.INFO)
+
+def test_rate_limiter_budgets():
+    now = [0.0]
+    limiter = RateLimiter(store_rate=(1, 2), lookup_rate=(10, 5), clock=lambda: now[0])
+
+    # Bursts up to the bucket size, per category
+    assert [limiter.allow("10.0.0.1", "store") for _ in range(3)] == [True, True, False]
+    assert all(limiter.allow("10.0.0.1", "find_node") for _ in range(5))
+    assert not limiter.allow("10.0.0.1", "ping")
+    # Other sources have their own budget
+    assert limiter.allow("10.0.0.2", "store")
+
+    # Tokens come back at the configured rate
+    now[0] = 1.0
+    assert limiter.allow("10.0.0.1", "store")
+    assert not limiter.allow("10.0.0.1", "store")
+
+def test_rate_limiter_is_bounded():
+    limiter = RateLimiter(max_sources=3)
+    for i in range(10):
+        limiter.allow(f"10.0.0.{i}", "find_value")
+    assert len(limiter) == 3
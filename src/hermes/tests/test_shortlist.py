@@ -0,0 +1,64 @@
+import pytest
+import logging
+
+from hermes.kademlia.Contact import Contact
+from hermes.kademlia.Shortlist import Shortlist, ContactState
+
+logging.basicConfig(level=logging.INFO)
+
+def test_shortlist_orders_and_dedups():
+    shortlist = Shortlist(0, k=2, exclude=(99,))
+
+    assert shortlist.add(Contact(None, 8, 'host', 1))
+    assert shortlist.add(Contact(None, 2, 'host', 1))
+    assert not shortlist.add(Contact(None, 8, 'host', 1))
+    # We never query ourselves
+    assert not shortlist.add(Contact(None, 99, 'host', 1))
+
+    assert shortlist.next_candidate().id == 2
+    assert shortlist.next_candidate().id == 8
+    assert shortlist.next_candidate() is None
+    assert shortlist.state(8) is ContactState.PENDING
+
+def test_shortlist_finishes_when_k_closest_responded():
+    shortlist = Shortlist(0, k=2)
+    shortlist.extend(Contact(None, i, 'host', 1) for i in (1, 2, 4, 16))
+
+    c1, c2 = shortlist.next_candidate(), shortlist.next_candidate()
+    shortlist.mark_responded(c2)
+    shortlist.mark_failed(c1)
+    assert not shortlist.is_finished()
+
+    c4 = shortlist.next_candidate()
+    shortlist.mark_responded(c4)
+    # 16 cannot be closer than the two closest that responded
+    assert shortlist.is_finished()
+    assert shortlist.next_candidate() is None
+    assert [c.id for c in shortlist.closest()] == [2, 4]
+
+def test_shortlist_prefers_faster_peers_in_band():
+    shortlist = Shortlist(0, k=2)
+    slow, fast, far = Contact(None, 4, 'host', 1), Contact(None, 7, 'host', 1), Contact(None, 8, 'host', 1)
+    slow.update_rtt(0.5)
+    fast.update_rtt(0.01)
+    far.update_rtt(0.001)
+    shortlist.extend((slow, fast, far))
+
+    # 4 and 7 share a band, 8 is farther whatever its speed
+    assert [shortlist.next_candidate().id for _ in range(3)] == [7, 4, 8]
+
+def test_contact_rtt_estimate():
+    contact = Contact(None, 1, 'host', 1)
+    assert contact.srtt is None
+
+    contact.update_rtt(0.2)
+    assert contact.srtt == pytest.approx(0.2)
+    assert contact.rttvar == pytest.approx(0.1)
+    assert contact.rto == pytest.approx(0.6)
+
+    for _ in range(50):
+        contact.update_rtt(0.01)
+    # Converges on a steady round trip time, within the bounds
+    assert contact.srtt == pytest.approx(0.01, abs=1e-3)
+    assert contact.rto >= 0.05
+    assert contact.timeout < 10
@@ -17,6 +17,12 @@ from hermes.kademlia.Node import Node
 from hermes.kademlia.Storage import Storage
 from hermes.net.UDPProtocol import UDPProtocol
 from hermes.net.UDPServer import UDPServer
+from hermes.net.UDPClient import UDPClient
+from hermes.net.ServerPool import ServerPool, ReplicaNode
+from hermes.net.RateLimiter import RateLimiter
+from hermes.net.TCPProtocol import TCPProtocol
+from hermes.net.Payload import PingRequest, FindNodeRequest, FindValueRequest, asdict
+from hermes.net.Wire import encode
 
 logging.basicConfig(level=logging.INFO)
 
@@ -251,4 +257,397 @@ async def test_unresponsive_ping():
 
     # Cleanup
     await server1.stop()
-    server1_task.cancel()
\ No newline at end of file
+    server1_task.cancel()
+@pytest.mark.asyncio
+async def test_rpcs_share_client_endpoint():
+    # Node 2 (server), port picked by the OS
+    id2 = random.randint(0, 2 ** 160 - 1)
+    n2 = Node(Contact(None, id2, host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    client = UDPClient()
+    p2 = UDPProtocol("127.0.0.1", addr[0][1], client=client)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+
+    # Many concurrent RPCs demultiplexed over the same socket
+    errors = await asyncio.gather(*(p2.ping(sender) for _ in range(20)))
+    assert not any(e.has_error() for e in errors)
+    assert client.pending == 0
+    # The server advertised the binary format, which is now used
+    assert client.speaks_binary(("127.0.0.1", addr[0][1]))
+
+    # RPCs through a contact measure its round trip time
+    peer = Contact(p2, id2, host="127.0.0.1", port=addr[0][1])
+    assert not (await p2.ping(sender)).has_error()
+    assert peer.srtt is not None and peer.timeout <= 10
+
+    known = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2723)
+    await n2.bucket_list.add_contact(known)
+
+    contacts, error = await p2.find_node(sender, random.randint(0, 2 ** 160 - 1))
+    assert not error.has_error()
+    # Returned contacts keep using our endpoint
+    assert all(c.protocol.client is client for c in contacts)
+
+    # The same peer is interned as a single object
+    again, error = await p2.find_node(sender, random.randint(0, 2 ** 160 - 1))
+    assert [c.id for c in contacts] == [known.id]
+    assert again[0] is contacts[0]
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_lost_request_is_retransmitted():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    # Lose the first datagram, and make handling outlast several retransmissions
+    protocol = server2.transport.get_protocol()
+    received = []
+    deliver = protocol.datagram_received
+    protocol.datagram_received = lambda data, a: received.append(data) or (len(received) > 1 and deliver(data, a))
+
+    calls = []
+    async def slow_ping(request):
+        calls.append(request)
+        await asyncio.sleep(0.2)
+        return await server2.handle_ping(request)
+    server2.handlers["ping"] = slow_ping
+
+    client = UDPClient()
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+    request = PingRequest(protocol_name="UDPProtocol", random_id=random.randint(0, 2 ** 160 - 1),
+                          sender=sender.id, sender_host=sender.host, sender_port=sender.port)
+
+    response = await client.request({"type": "ping", "data": asdict(request)}, ("127.0.0.1", addr[0][1]),
+                                    timeout=2, retransmit=0.05)
+    assert response["type"] == "ping_response"
+    assert len(received) > 2
+    # Retransmissions of the request being handled were not handled again
+    assert len(calls) == 1
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_full_request_queue_sheds_load():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0, workers=1, queue_size=1)
+    addr = []
+    await server2.start(addr.append)
+
+    async def slow_ping(request):
+        await asyncio.sleep(0.2)
+        return await server2.handle_ping(request)
+    server2.handlers["ping"] = slow_ping
+
+    client = UDPClient()
+    server_addr = ("127.0.0.1", addr[0][1])
+    client.mark_binary(server_addr)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+
+    def ping():
+        request = PingRequest(protocol_name="UDPProtocol", random_id=random.randint(0, 2 ** 160 - 1),
+                              sender=sender.id, sender_host=sender.host, sender_port=sender.port)
+        return client.request({"type": "ping", "data": asdict(request)}, server_addr, timeout=2, retransmit=1)
+
+    responses = await asyncio.gather(*(ping() for _ in range(5)))
+    busy = [r for r in responses if r["type"] == "error"]
+
+    # One request handled, one queued, the rest answered busy right away
+    assert len(busy) == 3
+    assert all(r["data"]["error_message"] == "Server busy." for r in busy)
+    assert server2.shed == 3
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_rate_limit_applies_before_queue():
+    now = [0.0]
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0, workers=1, queue_size=1,
+                        rate_limiter=RateLimiter(lookup_rate=(1, 2), clock=lambda: now[0]))
+    addr = []
+    await server2.start(addr.append)
+
+    async def slow_ping(request):
+        await asyncio.sleep(0.2)
+        return await server2.handle_ping(request)
+    server2.handlers["ping"] = slow_ping
+
+    client = UDPClient()
+    server_addr = ("127.0.0.1", addr[0][1])
+    client.mark_binary(server_addr)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+
+    def ping(random_id=None):
+        request = PingRequest(protocol_name="UDPProtocol", random_id=random_id or random.randint(0, 2 ** 160 - 1),
+                              sender=sender.id, sender_host=sender.host, sender_port=sender.port)
+        return client.request({"type": "ping", "data": asdict(request)}, server_addr, timeout=2, retransmit=1)
+
+    responses = await asyncio.gather(*(ping() for _ in range(5)))
+    limited = [r for r in responses if r["type"] == "error"]
+
+    # The burst of two is handled, the rest is refused without taking a place in the queue
+    assert len(limited) == 3
+    assert all(r["data"]["error_message"] == "Rate limited." for r in limited)
+    assert server2.shed == 0
+
+    # A refusal is not replayed to a retransmission once the budget has refilled
+    random_id = random.randint(0, 2 ** 160 - 1)
+    assert (await ping(random_id))["type"] == "error"
+    now[0] += 1
+    assert (await ping(random_id))["type"] == "ping_response"
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_server_pool_shares_port():
+    id2 = random.randint(0, 2 ** 160 - 1)
+    n2 = Node(Contact(None, id2, host="127.0.0.1", port=0), Storage())
+    # Answers the pings of n2 once its buckets fill up
+    known = Contact(Protocol(node=n2), random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2723)
+    await n2.bucket_list.add_contact(known)
+
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append, reuse_port=True)
+    pool = ServerPool(n2, "127.0.0.1", addr[0][1], 2, sync_interval=0.2)
+    await pool.start()
+    # Give the workers time to bind
+    await asyncio.sleep(1)
+    assert pool.alive == 2
+
+    # Separate endpoints, so the kernel spreads them across the processes
+    clients = [UDPClient() for _ in range(8)]
+    senders = [Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=3000 + i) for i in range(8)]
+    protocols = [UDPProtocol("127.0.0.1", addr[0][1], client=client) for client in clients]
+
+    results = await asyncio.gather(*(p.find_node(s, known.id) for p, s in zip(protocols, senders)))
+    assert all(not error.has_error() and known.id in [c.id for c in contacts] for contacts, error in results)
+
+    key = random.randint(0, 2 ** 160 - 1)
+    errors = await asyncio.gather(*(p.store(s, key + i, "Test") for i, (p, s) in enumerate(zip(protocols, senders))))
+    assert not any(e.has_error() for e in errors)
+
+    await pool.stop()
+    # Every STORE reached the owning node, whichever process took it
+    assert all(n2.storage.contains(key + i) for i in range(8))
+
+    for client in clients:
+        client.close()
+    await server2.stop()
+
+def test_server_pool_syncs_changes_only():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    n2.storage.set(1, "One")
+    pool = ServerPool(n2, "127.0.0.1", 0, 1)
+    replica = ReplicaNode(Contact(None, n2.our_contact.id, "127.0.0.1", 0), None)
+    replica.load(pool.snapshot())
+    pool._sent_buckets, pool._sent_store = pool.snapshot()
+
+    # Nothing sent while nothing changes
+    assert pool.update() is None
+
+    n2.storage.set(2, "Two")
+    buckets, changed, removed = pool.update()
+    assert buckets is None and changed == {2: "Two"} and removed == []
+    assert pool.update() is None
+
+    replica.apply((buckets, changed, removed))
+    assert replica.storage.get(1) == "One" and replica.storage.get(2) == "Two"
+
+@pytest.mark.asyncio
+async def test_large_value_is_fragmented():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    client = UDPClient()
+    p2 = UDPProtocol("127.0.0.1", addr[0][1], client=client)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+    # Learn that the server speaks binary, which fragmentation needs, then from its first
+    # binary response that it accepts compression
+    assert not (await p2.ping(sender)).has_error()
+    assert not (await p2.ping(sender)).has_error()
+    assert client.accepts_compression(("127.0.0.1", addr[0][1]))
+
+    # Far more than fits in a datagram
+    key = random.randint(0, 2 ** 160 - 1)
+    # Random enough to still need fragments once compressed, small enough to stay off TCP
+    value = "".join(random.choice("abcdef") for _ in range(30000))
+    error = await p2.store(sender, key, value)
+    assert not error.has_error()
+    assert n2.storage.get(key) == value
+
+    contacts, found, error = await p2.find_value(sender, key)
+    assert not error.has_error()
+    assert found == value
+    assert client.tcp.connections == 0
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_tcp_transport():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    client = UDPClient()
+    p2 = TCPProtocol("127.0.0.1", addr[0][1], client=client)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+
+    # Pipelined over the pooled connections
+    errors = await asyncio.gather(*(p2.ping(sender) for _ in range(20)))
+    assert not any(e.has_error() for e in errors)
+    assert 1 <= client.tcp.connections <= 2
+
+    key = random.randint(0, 2 ** 160 - 1)
+    value = "".join(random.choice("abcdef") for _ in range(500000))
+    assert not (await p2.store(sender, key, value)).has_error()
+    contacts, found, error = await p2.find_value(sender, key)
+    assert found == value
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_tcp_requests_share_request_queue():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0, workers=1, queue_size=1)
+    addr = []
+    await server2.start(addr.append)
+
+    async def slow_ping(request):
+        await asyncio.sleep(0.2)
+        return await server2.handle_ping(request)
+    server2.handlers["ping"] = slow_ping
+
+    client = UDPClient()
+    p2 = TCPProtocol("127.0.0.1", addr[0][1], client=client)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+
+    errors = await asyncio.gather(*(p2.ping(sender) for _ in range(5)))
+
+    # One request handled, one queued, the rest answered busy right away
+    busy = [e for e in errors if e.peer_error]
+    assert len(busy) == 3
+    assert all(e.peer_error_message == "Server busy." for e in busy)
+    assert server2.shed == 3
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_udp_protocol_switches_to_tcp():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    client = UDPClient()
+    p2 = UDPProtocol("127.0.0.1", addr[0][1], client=client)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+    value = "x" * 100000
+
+    # Small requests use UDP, a large value goes over TCP
+    assert not (await p2.ping(sender)).has_error()
+    assert client.tcp.connections == 0
+    assert not (await p2.store(sender, 1, value)).has_error()
+    assert client.tcp.connections == 1
+
+    # Without a TCP server, the same request falls back to UDP
+    server2.tcp_server.close()
+    server2.tcp_server.close_clients()
+    client.tcp.close()
+    p3 = UDPProtocol("127.0.0.1", addr[0][1], client=client)
+    assert not (await p3.store(sender, 2, value)).has_error()
+    assert n2.storage.get(2) == value
+    assert not client.tcp.accepts(("127.0.0.1", addr[0][1]))
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_duplicate_request_replays_response():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    calls = []
+    async def counted_find_node(request):
+        calls.append(request)
+        return await server2.handle_find_node(request)
+    server2.handlers["find_node"] = counted_find_node
+
+    client = UDPClient()
+    server_addr = ("127.0.0.1", addr[0][1])
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+    request = FindNodeRequest(protocol_name="UDPProtocol", random_id=random.randint(0, 2 ** 160 - 1),
+                              sender=sender.id, sender_host=sender.host, sender_port=sender.port, key=1)
+
+    # The same request twice, in JSON then in binary once the server is known to speak it
+    first = await client.request({"type": "find_node", "data": asdict(request)}, server_addr)
+    second = await client.request({"type": "find_node", "data": asdict(request)}, server_addr)
+    client.mark_binary(server_addr)
+    third = await client.request({"type": "find_node", "data": asdict(request)}, server_addr)
+
+    assert first == second
+    assert third["data"]["random_id"] == request.random_id
+    # Only the first was handled
+    assert len(calls) == 1
+
+    client.close()
+    await server2.stop()
+
+@pytest.mark.asyncio
+async def test_duplicate_of_fragmented_response_keeps_message_id():
+    n2 = Node(Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=0), Storage())
+    n2.storage.set(1, "".join(random.choice("0123456789abcdef") for _ in range(20000)))
+    server2 = UDPServer(n2, "127.0.0.1", 0)
+    addr = []
+    await server2.start(addr.append)
+
+    client = UDPClient()
+    server_addr = ("127.0.0.1", addr[0][1])
+    client.mark_binary(server_addr)
+    sender = Contact(None, random.randint(0, 2 ** 160 - 1), host="127.0.0.1", port=2722)
+    request = {"type": "find_value", "data": asdict(FindValueRequest(
+        protocol_name="UDPProtocol", random_id=random.randint(0, 2 ** 160 - 1),
+        sender=sender.id, sender_host=sender.host, sender_port=sender.port, key=1))}
+
+    response = await client.request(request, server_addr)
+    assert response["data"]["value"] == n2.storage.get(1)
+
+    sent = []
+    transport = server2.protocol.transport
+    sendto = transport.sendto
+    transport.sendto = lambda data, addr: (sent.append(data), sendto(data, addr))
+
+    # Without a NACK since, a retransmission gets all the fragments again, under the original message id
+    (client_addr, _), = server2.protocol._responses
+    fragments = next(iter(server2.protocol._fragments._sent.values())).fragments
+    server2.protocol.datagram_received(encode(request, True), client_addr)
+    assert sent == fragments
+    assert len(server2.protocol._fragments._sent) == 1
+
+    # Once the client asked for missing fragments, a retransmission only probes with the first one
+    next(iter(server2.protocol._fragments._sent.values())).nacked = True
+    sent.clear()
+    server2.protocol.datagram_received(encode(request, True), client_addr)
+    assert sent == fragments[:1]
+
+    transport.sendto = sendto
+    client.close()
+    await server2.stop()
@@ -0,0 +1,75 @@
+import json
+import random
+
+import pytest
+import logging
+
+from dataclasses import asdict
+
+from hermes.net.Payload import FindNodeResponse, FindValueResponse, ContactResponse, StoreRequest, ErrorResponse
+from hermes.net.Wire import encode, decode, is_binary, accepts_compression, WireError
+
+logging.basicConfig(level=logging.INFO)
+
+def contacts(random_id, n):
+    return [ContactResponse(random_id=random_id, contact=random.randint(0, 2**160 - 1), protocol_name='UDPProtocol',
+                            host=f"10.0.0.{i}", port=3000 + i) for i in range(n)]
+
+def test_binary_round_trip():
+    random_id = random.randint(0, 2**160 - 1)
+    store = StoreRequest(protocol_name='UDPProtocol', random_id=random_id, sender=2**160 - 1, sender_host="127.0.0.1",
+                         sender_port=3301, key=0, value="héllo", exp_time=1000)
+    message = decode(encode({"type": "store", "data": asdict(store)}, binary=True))
+    assert message["type"] == "store"
+    assert message["data"] == asdict(store)
+
+    value = FindValueResponse(random_id=random_id, contacts=None, value="Test")
+    message = decode(encode({"type": "find_value_response", "data": asdict(value)}, binary=True))
+    assert message["data"] == {"random_id": random_id, "contacts": None, "value": "Test"}
+
+    error = ErrorResponse(random_id=random_id, error_message="Invalid Protocol.")
+    assert decode(encode({"type": "error", "data": asdict(error)}, binary=True))["data"] == asdict(error)
+
+def test_find_node_response_is_smaller():
+    random_id = random.randint(0, 2**160 - 1)
+    response = {"type": "find_node_response", "data": asdict(FindNodeResponse(random_id, contacts(random_id, 20)))}
+
+    binary = encode(response, binary=True)
+    assert is_binary(binary)
+    assert len(binary) * 4 < len(encode(response))
+
+    decoded = decode(binary)["data"]["contacts"]
+    assert [(c["contact"], c["host"], c["port"]) for c in decoded] == \
+           [(c["contact"], c["host"], c["port"]) for c in response["data"]["contacts"]]
+
+def test_falls_back_to_json():
+    # Ids wider than 160 bits and host names do not fit the binary layout
+    request = {"type": "ping", "data": {"protocol_name": 'UDPProtocol', "random_id": 1, "sender": 2**160,
+                                        "sender_host": "host", "sender_port": 1}}
+    data = encode(request, binary=True)
+    assert not is_binary(data)
+    assert json.loads(data)["wire"] == 1
+    assert decode(data)["data"] == request["data"]
+
+def test_truncated_binary_message():
+    data = encode({"type": "ping_response", "data": {"random_id": 5}}, binary=True)
+    with pytest.raises(WireError):
+        decode(data[:-1])
+
+def test_compressed_round_trip():
+    random_id = random.randint(0, 2**160 - 1)
+    value = FindValueResponse(random_id=random_id, contacts=None, value=json.dumps(list(range(2000))))
+    message = {"type": "find_value_response", "data": asdict(value)}
+
+    plain = encode(message, binary=True)
+    compressed = encode(message, binary=True, compress=True)
+    assert accepts_compression(plain)
+    assert len(compressed) < len(plain) / 2
+    assert decode(compressed)["data"] == asdict(value)
+
+    # Small messages are not worth compressing
+    ping = {"type": "ping_response", "data": {"random_id": random_id}}
+    assert encode(ping, binary=True, compress=True) == encode(ping, binary=True)
+
+    with pytest.raises(WireError):
+        decode(compressed[:-10])